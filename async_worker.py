@@ -21,3 +21,26 @@ class AsyncWorker(QRunnable):
         self.fn(*self.args, **self.kwargs)
         self.signals.finished.emit(*self.args, **self.kwargs)
 
+
+class TaskSignals(QObject):
+    # Return value of the task, error message or empty string on success
+    done = pyqtSignal(object, str)
+
+class TaskWorker(QRunnable):
+
+    def __init__(self, fn, *args, **kwargs):
+        super(TaskWorker, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = TaskSignals()
+
+    @pyqtSlot()
+    def run(self):
+        result = None
+        error = ''
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except Exception as ex:
+            error = str(ex) or ex.__class__.__name__
+        self.signals.done.emit(result, error)
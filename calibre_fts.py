@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+
+from calibre_plugins.caps.fingerprint import content_hash
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+TITLE = 'Power Search'
+
+# Kept by Calibre 6 and later in the library folder while its full text
+# search is enabled
+CALIBRE_FTS_FILE_NAME = 'full-text-search.db'
+
+# Calibre stores the hex digest of the file the text was extracted from
+HASH_ALGORITHMS = {40: 'sha1', 64: 'sha256'}
+
+
+class CalibreTextSource(object):
+    # Text Calibre has already extracted from the library's books for its own
+    # full text search. Read through a separate read-only connection, so
+    # conversion workers never wait for Calibre's database lock
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(self.path)), uri=True, timeout=30.0)
+            self.local.conn = conn
+        return conn
+
+    # Returns a list of lines, or None when Calibre has no current text for
+    # the format
+    def get(self, book_id, format, input):
+        try:
+            conn = self._conn()
+            # Only the columns stored before the text, which is read once the
+            # file is known to be the one it was extracted from
+            row = conn.execute(
+                'SELECT id, format_size, format_hash FROM books_text WHERE book = ? AND format = ?'
+                ' AND NOT EXISTS (SELECT 1 FROM dirtied_formats d WHERE d.book = ? AND d.format = ?)',
+                (book_id, format, book_id, format)).fetchone()
+            if not row:
+                return None
+            rowid, size, digest = row
+            if os.path.getsize(input) != size or not self._same_content(input, digest):
+                return None
+            row = conn.execute(
+                'SELECT searchable_text, err_msg FROM books_text WHERE id = ?', (rowid,)).fetchone()
+        except (OSError, sqlite3.Error) as ex:
+            print('{}> Could not read Calibre full text index: {}'.format(TITLE, ex))
+            return None
+        if not row or not row[0] or row[1]:
+            return None
+        return row[0].splitlines(True)
+
+    def _same_content(self, input, digest):
+        algorithm = HASH_ALGORITHMS.get(len(digest or ''))
+        if algorithm is None:
+            return False
+        return content_hash(input, algorithm) == digest.lower()
+
+
+def get_calibre_text_source(db):
+    # None unless full text search is enabled for the library, otherwise
+    # Calibre stops keeping its text current
+    try:
+        if not db.is_fts_enabled():
+            return None
+        path = os.path.join(db.backend.library_path, CALIBRE_FTS_FILE_NAME)
+    except AttributeError:
+        return None
+    if not os.path.isfile(path):
+        return None
+
+    return CalibreTextSource(path)
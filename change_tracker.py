@@ -0,0 +1,83 @@
+import threading
+
+TITLE = 'Power Search'
+
+
+class ChangeTracker(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.db = None
+        self.dirty = set()
+        self.reconciled = False
+        self.supported = False
+        # Bumped whenever earlier scans no longer count
+        self.invalidations = 0
+
+    def attach(self, db):
+        if db is self.db:
+            return
+
+        if self.db is not None and self.supported:
+            try:
+                self.db.remove_listener(self.listener)
+            except Exception:
+                pass
+
+        # Calibre keeps weak references to listeners, hence the attribute
+        self.listener = self.on_event
+        with self.lock:
+            self.db = db
+            self.dirty = set()
+            self.reconciled = False
+            self.invalidations += 1
+
+        try:
+            db.add_listener(self.listener)
+            self.supported = True
+        except AttributeError:
+            print('{}> Library change notifications are not supported by this version of Calibre'.format(TITLE))
+            self.supported = False
+
+    def on_event(self, library_id, event_type, event_data):
+        from calibre.db.listeners import EventType
+
+        if event_type in (EventType.book_created, EventType.format_added, EventType.book_edited):
+            book_ids = [event_data[0]]
+        elif event_type == EventType.books_removed:
+            book_ids = event_data[0]
+        elif event_type == EventType.formats_removed:
+            book_ids = event_data[0].keys()
+        elif event_type in (EventType.metadata_changed, EventType.items_renamed, EventType.items_removed) and event_data[0] == 'tags':
+            # Adding or removing 'noindex' tag, also by renaming or deleting
+            # it in the Tag browser
+            book_ids = event_data[1]
+        else:
+            return
+
+        with self.lock:
+            self.dirty.update(book_ids)
+
+    def needs_full_scan(self):
+        return not self.supported or not self.reconciled
+
+    def take_dirty(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+        return dirty
+
+    def restore(self, book_ids):
+        with self.lock:
+            self.dirty.update(book_ids)
+
+    # Taken when a full scan starts; the scan is stale once the token changes
+    def scan_token(self):
+        return self.invalidations
+
+    def mark_reconciled(self):
+        self.reconciled = True
+
+    def invalidate(self):
+        self.invalidations += 1
+        self.reconciled = False
@@ -9,16 +9,28 @@ TITLE = 'Power Search'
 
 ARCHIVE_FORMATS = ['7Z', 'ZIP', 'RAR']
 
-SUPPORTED_FORMATS = sorted(['AZW3', 'AZW4', 'CBR', 'CBZ', 'CHM', 'DJV', 'DJVU', 'DOC', 'DOCX', 'EPUB', 'FB2', 'KFX', 'MOBI', 'PDB', 'PDF', 'RTF', 'TXT'] + ARCHIVE_FORMATS)
+SUPPORTED_FORMATS = sorted(['AZW3', 'AZW4', 'CBR', 'CBZ', 'CHM', 'DJV', 'DJVU', 'DOC', 'DOCX', 'EPUB', 'FB2', 'HTML', 'KFX', 'MOBI', 'PDB', 'PDF', 'RTF', 'TXT'] + ARCHIVE_FORMATS)
 
 prefs = JSONConfig('plugins/caps')
 
+prefs.defaults['search_backend'] = 'elasticsearch'
 prefs.defaults['elasticsearch_url'] = 'localhost:9200'
 prefs.defaults['elasticsearch_launch_path'] = None
 prefs.defaults['pdftotext_path'] = 'pdftotext'
 prefs.defaults['concurrency'] = multiprocessing.cpu_count()-1 or 1
 prefs.defaults['file_formats'] = ','.join(SUPPORTED_FORMATS)
 prefs.defaults['autoindex'] = True
+prefs.defaults['background_indexing'] = True
+prefs.defaults['text_cache_size_mb'] = 2048
+prefs.defaults['use_calibre_fts'] = True
+prefs.defaults['pdf_split_pages'] = 500
+prefs.defaults['search_page_size'] = 5000
+prefs.defaults['result_cache_on_disk'] = False
+prefs.defaults['live_count_preview'] = True
+prefs.defaults['optimize_after_rebuild'] = True
+prefs.defaults['bulk_load_restore'] = {}
+prefs.defaults['elasticsearch_idle_minutes'] = 60
+prefs.defaults['elasticsearch_library_index_bytes'] = {}
 
 
 class ConfigWidget(QWidget):
@@ -33,6 +45,12 @@ class ConfigWidget(QWidget):
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
 
+        self.builtin_search_checkbox = QCheckBox("Use built-in search engine instead of ElasticSearch", self)
+        self.builtin_search_checkbox.setCheckState(Qt.CheckState.Checked if prefs['search_backend'] == 'sqlite' else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.builtin_search_checkbox)
+
+        self.layout.addSpacing(10)
+
         self.engine_location_label = QLabel('ElasticSearch engine network path:')
         self.layout.addWidget(self.engine_location_label)
 
@@ -53,6 +71,16 @@ class ConfigWidget(QWidget):
 
         self.layout.addSpacing(10)
 
+        self.idle_minutes_label = QLabel('Stop launched ElasticSearch after this many idle minutes (0 = when Calibre exits):')
+        self.layout.addWidget(self.idle_minutes_label)
+
+        self.idle_minutes_textbox = QLineEdit(self)
+        self.idle_minutes_textbox.setText(str(prefs['elasticsearch_idle_minutes']))
+        self.layout.addWidget(self.idle_minutes_textbox)
+        self.idle_minutes_label.setBuddy(self.idle_minutes_textbox)
+
+        self.layout.addSpacing(10)
+
         self.pdftotext_path_label = QLabel('Path to pdftotext tool:')
         self.layout.addWidget(self.pdftotext_path_label)
 
@@ -73,6 +101,36 @@ class ConfigWidget(QWidget):
 
         self.layout.addSpacing(10)
 
+        self.pdf_split_pages_label = QLabel('Split PDF books with more pages than this into parallel page ranges:')
+        self.layout.addWidget(self.pdf_split_pages_label)
+
+        self.pdf_split_pages_textbox = QLineEdit(self)
+        self.pdf_split_pages_textbox.setText(str(prefs['pdf_split_pages']))
+        self.layout.addWidget(self.pdf_split_pages_textbox)
+        self.pdf_split_pages_label.setBuddy(self.pdf_split_pages_textbox)
+
+        self.layout.addSpacing(10)
+
+        self.text_cache_size_label = QLabel('Extracted text cache size limit (MB):')
+        self.layout.addWidget(self.text_cache_size_label)
+
+        self.text_cache_size_textbox = QLineEdit(self)
+        self.text_cache_size_textbox.setText(str(prefs['text_cache_size_mb']))
+        self.layout.addWidget(self.text_cache_size_textbox)
+        self.text_cache_size_label.setBuddy(self.text_cache_size_textbox)
+
+        self.layout.addSpacing(10)
+
+        self.search_page_size_label = QLabel('Number of search results fetched per request:')
+        self.layout.addWidget(self.search_page_size_label)
+
+        self.search_page_size_textbox = QLineEdit(self)
+        self.search_page_size_textbox.setText(str(prefs['search_page_size']))
+        self.layout.addWidget(self.search_page_size_textbox)
+        self.search_page_size_label.setBuddy(self.search_page_size_textbox)
+
+        self.layout.addSpacing(10)
+
         self.formats_label = QLabel('Index book formats:')
         self.layout.addWidget(self.formats_label)
 
@@ -93,6 +151,26 @@ class ConfigWidget(QWidget):
         self.autoindex_checkbox.setCheckState(Qt.CheckState.Checked if prefs['autoindex'] else Qt.CheckState.Unchecked)
         self.layout.addWidget(self.autoindex_checkbox)
 
+        self.background_indexing_checkbox = QCheckBox("Index new books in the background while Calibre is idle", self)
+        self.background_indexing_checkbox.setCheckState(Qt.CheckState.Checked if prefs['background_indexing'] else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.background_indexing_checkbox)
+
+        self.use_calibre_fts_checkbox = QCheckBox("Reuse text extracted by Calibre's full text search", self)
+        self.use_calibre_fts_checkbox.setCheckState(Qt.CheckState.Checked if prefs['use_calibre_fts'] else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.use_calibre_fts_checkbox)
+
+        self.result_cache_on_disk_checkbox = QCheckBox("Remember search results on disk", self)
+        self.result_cache_on_disk_checkbox.setCheckState(Qt.CheckState.Checked if prefs['result_cache_on_disk'] else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.result_cache_on_disk_checkbox)
+
+        self.live_count_preview_checkbox = QCheckBox("Show estimated number of matching books while typing", self)
+        self.live_count_preview_checkbox.setCheckState(Qt.CheckState.Checked if prefs['live_count_preview'] else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.live_count_preview_checkbox)
+
+        self.optimize_after_rebuild_checkbox = QCheckBox("Optimize the index after reindexing all books", self)
+        self.optimize_after_rebuild_checkbox.setCheckState(Qt.CheckState.Checked if prefs['optimize_after_rebuild'] else Qt.CheckState.Unchecked)
+        self.layout.addWidget(self.optimize_after_rebuild_checkbox)
+
         self.layout.addSpacing(10)
 
         self.privacy_label = QLabel('Privacy:')
@@ -106,7 +184,15 @@ class ConfigWidget(QWidget):
         self.clear_search_index_buttin.clicked.connect(self.on_clear_index)
         self.layout.addWidget(self.clear_search_index_buttin)
 
+        self.clear_text_cache_button = QPushButton('Clear extracted text &cache', self)
+        self.clear_text_cache_button.clicked.connect(self.on_clear_text_cache)
+        self.layout.addWidget(self.clear_text_cache_button)
+
     def save_settings(self):
+        file_formats_before = set(prefs['file_formats'].split(','))
+        search_backend_before = prefs['search_backend']
+
+        prefs['search_backend'] = 'sqlite' if self.builtin_search_checkbox.checkState() == Qt.CheckState.Checked else 'elasticsearch'
         prefs['elasticsearch_url'] = self.elasticsearch_url_textbox.text()
         prefs['elasticsearch_launch_path'] = self.elasticsearch_launch_path_textbox.text()
         prefs['pdftotext_path'] = self.pdftotext_path_textbox.text()
@@ -114,19 +200,52 @@ class ConfigWidget(QWidget):
             prefs['concurrency'] = int(self.concurrency_textbox.text())
         except Exception:
             pass
+        try:
+            prefs['elasticsearch_idle_minutes'] = max(0, int(self.idle_minutes_textbox.text()))
+        except Exception:
+            pass
+        try:
+            prefs['pdf_split_pages'] = int(self.pdf_split_pages_textbox.text())
+        except Exception:
+            pass
+        try:
+            prefs['text_cache_size_mb'] = int(self.text_cache_size_textbox.text())
+        except Exception:
+            pass
+        try:
+            prefs['search_page_size'] = max(1, min(10000, int(self.search_page_size_textbox.text())))
+        except Exception:
+            pass
         file_formats = []
         for i in range(len(SUPPORTED_FORMATS)):
             if self.formats_list.item(i).checkState() == Qt.CheckState.Checked:
                 file_formats.append(self.formats_list.item(i).text())
         prefs['file_formats'] = ','.join(file_formats)
         prefs['autoindex'] = True if self.autoindex_checkbox.checkState() == Qt.CheckState.Checked else False
+        prefs['background_indexing'] = True if self.background_indexing_checkbox.checkState() == Qt.CheckState.Checked else False
+        prefs['use_calibre_fts'] = True if self.use_calibre_fts_checkbox.checkState() == Qt.CheckState.Checked else False
+        prefs['result_cache_on_disk'] = True if self.result_cache_on_disk_checkbox.checkState() == Qt.CheckState.Checked else False
+        prefs['live_count_preview'] = True if self.live_count_preview_checkbox.checkState() == Qt.CheckState.Checked else False
+        prefs['optimize_after_rebuild'] = True if self.optimize_after_rebuild_checkbox.checkState() == Qt.CheckState.Checked else False
+
+        # Newly enabled formats and the other backend's own index are only
+        # picked up by a full scan
+        if set(file_formats) != file_formats_before or prefs['search_backend'] != search_backend_before:
+            self._invalidate_change_tracker()
+
+    def _invalidate_change_tracker(self):
+        if self.plugin and self.plugin.search_dialog:
+            self.plugin.search_dialog.change_tracker.invalidate()
 
     def on_clear_history(self):
         from calibre.gui2 import info_dialog
+        from calibre_plugins.caps.result_cache import get_result_cache
 
         if 'search_lru' in prefs:
             del prefs['search_lru']
 
+        get_result_cache().clear()
+
         if self.plugin.search_dialog:
             self.plugin.search_dialog.clear_lru()
 
@@ -136,6 +255,18 @@ class ConfigWidget(QWidget):
             'History cleared',
             show=True)
 
+    def on_clear_text_cache(self):
+        from calibre.gui2 import info_dialog
+        from calibre_plugins.caps.text_cache import get_text_cache
+
+        get_text_cache().clear()
+
+        info_dialog(
+            self,
+            TITLE,
+            'Extracted text cache cleared',
+            show=True)
+
     def on_clear_index(self):
         from calibre.gui2 import question_dialog, error_dialog
 
@@ -145,26 +276,43 @@ class ConfigWidget(QWidget):
             'You are about to clear all fulltext search index. Rebuilding it might take a while. Are you sure?',
             default_yes=False):
 
-            elastic_search_client, reason = get_elasticsearch_client(self, TITLE, prefs['elasticsearch_url'], prefs['elasticsearch_launch_path'])
+            from calibre_plugins.caps.index_state import get_index_state_store
+            from calibre_plugins.caps.search_backend import BACKEND_SQLITE, get_library_alias, get_sqlite_backend, get_state_id
+
+            library_id = self.plugin.gui.current_db.new_api.library_id
+
+            if prefs['search_backend'] == BACKEND_SQLITE:
+                get_sqlite_backend(library_id).clear()
+            else:
+                elastic_search_client, reason = get_elasticsearch_client(self, TITLE, prefs['elasticsearch_url'], prefs['elasticsearch_launch_path'])
+
+                if not elastic_search_client:
+
+                    error_dialog(
+                        self,
+                        TITLE,
+                        reason,
+                        show=True)
+                    return
 
-            if not elastic_search_client:
+                if not elastic_search_client.ping():
 
-                error_dialog(
-                    self,
-                    TITLE,
-                    reason,
-                    show=True)
-                return
+                    error_dialog(
+                        self,
+                        TITLE,
+                        'Could not connect to ElasticSearch cluster. Please make sure that it\'s running.',
+                        show=True)
+                    return
 
-            if not elastic_search_client.ping():
+                from calibre_plugins.caps.index_helper import delete_library_index
 
-                error_dialog(
-                    self,
-                    TITLE,
-                    'Could not connect to ElasticSearch cluster. Please make sure that it\'s running.',
-                    show=True)
-                return
+                delete_library_index(elastic_search_client, get_library_alias(library_id))
 
-            elastic_search_client.indices.delete(index='library', ignore=[400, 404])
+            state_id = get_state_id(library_id)
+            index_state = get_index_state_store()
+            index_state.migrate_from_prefs(prefs, library_id)
+            index_state.clear(state_id)
+            index_state.bump_generation(state_id)
 
-            prefs[self.plugin.gui.current_db.new_api.library_id] = {'index_state': {}}
+            # Every book has to be indexed again, not only the changed ones
+            self._invalidate_change_tracker()
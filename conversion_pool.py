@@ -0,0 +1,165 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+
+import psutil
+
+TITLE = 'Power Search'
+
+# A worker is replaced after this many conversions or once it grows beyond
+# this resident memory size, whichever comes first
+MAX_JOBS_PER_WORKER = 100
+MAX_WORKER_MEMORY = 1024 * 1024 * 1024
+
+WORKER_COMMAND = 'from calibre.customize.ui import find_plugin; from calibre_plugins.caps.conversion_pool import worker_main; worker_main()'
+
+
+def worker_main():
+    # Conversion logging goes to stdout, so keep the original descriptor for
+    # the job protocol and send everything else to the null device
+    out = os.fdopen(os.dup(sys.__stdout__.fileno()), 'wb')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.__stdout__.fileno())
+    sys.stdout = open(os.devnull, 'w')
+
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.utils.logging import Log
+
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        job = json.loads(line.decode('utf-8'))
+        res = {'ok': True}
+        try:
+            plumber = Plumber(job['input'], job['output'], Log())
+            plumber.merge_ui_recommendations([])
+            plumber.run()
+        except Exception as ex:
+            res = {'ok': False, 'error': str(ex)}
+        out.write(json.dumps(res).encode('utf-8') + b'\n')
+        out.flush()
+
+
+class ConversionWorker(object):
+
+    def __init__(self):
+        from calibre.utils.ipc.simple_worker import start_pipe_worker
+        self.process = start_pipe_worker(WORKER_COMMAND)
+        self.jobs = 0
+
+    def convert(self, input, output):
+        self.jobs += 1
+        self.process.stdin.write(json.dumps({'input': input, 'output': output}).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('conversion worker exited unexpectedly')
+        res = json.loads(line.decode('utf-8'))
+        if not res['ok']:
+            print('{}> {}'.format(TITLE, res['error']))
+        return res['ok']
+
+    def exhausted(self):
+        if self.jobs >= MAX_JOBS_PER_WORKER:
+            return True
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss > MAX_WORKER_MEMORY
+        except Exception:
+            return True
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(5)
+        except Exception:
+            try:
+                self.process.kill()
+            except Exception:
+                pass
+
+
+class ConversionPool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.surplus = 0
+        # Holds idle workers plus one None for every worker not started yet
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def _acquire(self):
+        while True:
+            worker = self.idle.get()
+            with self.lock:
+                if self.surplus > 0:
+                    self.surplus -= 1
+                    if worker:
+                        worker.stop()
+                    continue
+            if worker:
+                return worker
+            try:
+                return ConversionWorker()
+            except Exception:
+                self.idle.put(None)
+                raise
+
+    def _release(self, worker, broken=False):
+        if broken or worker.exhausted():
+            worker.stop()
+            worker = None
+        self.idle.put(worker)
+
+    def convert(self, input, output):
+        worker = self._acquire()
+        try:
+            ok = worker.convert(input, output)
+        except Exception:
+            self._release(worker, broken=True)
+            raise
+        self._release(worker)
+        return ok
+
+    def resize(self, size):
+        with self.lock:
+            if size > self.size:
+                for _ in range(size - self.size):
+                    self.idle.put(None)
+            else:
+                self.surplus += self.size - size
+            self.size = size
+
+    def shutdown(self):
+        workers = []
+        while True:
+            try:
+                workers.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        for worker in workers:
+            if worker:
+                worker.stop()
+            self.idle.put(None)
+
+
+_pool = None
+
+def get_conversion_pool():
+    global _pool
+
+    from calibre_plugins.caps.config import prefs
+
+    if _pool is None:
+        _pool = ConversionPool(prefs['concurrency'])
+        atexit.register(_pool.shutdown)
+    elif _pool.size != prefs['concurrency']:
+        _pool.resize(prefs['concurrency'])
+
+    return _pool
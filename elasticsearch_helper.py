@@ -1,12 +1,15 @@
 import atexit
-from calibre_plugins.caps.elasticsearch import Elasticsearch
+from calibre_plugins.caps.elasticsearch import Elasticsearch, Transport
+from calibre_plugins.caps.elasticsearch.exceptions import ConnectionError, TransportError
+import glob
+from calibre_plugins.caps import node_lifecycle
 from calibre_plugins.caps.subprocess_helper import subprocess_call, subprocess_popen
-import json
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.Qt import Qt
 from PyQt5.QtCore import pyqtSlot
 import os
 import psutil
+import re
 import time
 
 if os.name == 'nt':
@@ -21,6 +24,71 @@ elasticsearch_process = None
 elasticsearch_subprocess = None
 msgbox = None
 ok = False
+shutdown_hook_registered = False
+
+# Readiness is polled with exponential backoff between these intervals
+LAUNCH_TIMEOUT = 60.0
+READY_POLL_MIN = 0.1
+READY_POLL_MAX = 2.0
+
+NODE_STARTED_RE = re.compile(r'\]\s+started\b')
+# Only errors the node does not recover from
+NODE_FAILED_RE = re.compile(r'fatal exception|node validation exception|BindException|Address already in use', re.IGNORECASE)
+
+# Background checks do not ping a cluster found down more often than this
+HEALTH_RETRY_INTERVAL = 60.0
+
+# One client for the whole Calibre session, so its connections are kept
+# alive between requests. Once validated it is trusted until a request
+# fails, only then is the cluster checked again
+shared_client = None
+shared_client_url = None
+healthy = False
+failed_at = None
+
+
+class HealthTrackingTransport(Transport):
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        global healthy
+
+        try:
+            res = Transport.perform_request(self, method, url, headers=headers, params=params, body=body)
+            node_lifecycle.touch()
+            return res
+        except ConnectionError:
+            healthy = False
+            raise
+        except TransportError as ex:
+            if isinstance(ex.status_code, int) and ex.status_code >= 500:
+                healthy = False
+            raise
+
+def _get_shared_client(_url):
+    global shared_client
+    global shared_client_url
+    global healthy
+    global failed_at
+
+    if shared_client is None or shared_client_url != _url:
+        if shared_client is not None:
+            try:
+                shared_client.close()
+            except Exception:
+                pass
+        shared_client = Elasticsearch([_url], timeout=60.0, transport_class=HealthTrackingTransport)
+        shared_client_url = _url
+        healthy = False
+        failed_at = None
+
+    return shared_client
+
+def _set_health(value):
+    global healthy
+    global failed_at
+
+    healthy = value
+    failed_at = None if value else time.time()
 
 def terminate_elasticsearch_process():
     global launch_path
@@ -53,9 +121,103 @@ def terminate_elasticsearch_process():
             except Exception:
                 pass
 
+        node_lifecycle.forget()
+
     elasticsearch_process = None
     elasticsearch_subprocess = None
 
+def shutdown_elasticsearch_process():
+    from calibre_plugins.caps.config import prefs
+
+    if elasticsearch_process and prefs['elasticsearch_idle_minutes'] > 0:
+        # Kept warm for the next Calibre session, the watchdog stops the node
+        # once it has been idle long enough
+        node_lifecycle.ensure_watchdog()
+        return
+    terminate_elasticsearch_process()
+
+def _register_shutdown_hook():
+    global shutdown_hook_registered
+
+    if not shutdown_hook_registered:
+        atexit.register(shutdown_elasticsearch_process)
+        shutdown_hook_registered = True
+
+def _attach_elasticsearch_process(_url):
+    global launch_path
+    global elasticsearch_process
+    global elasticsearch_subprocess
+
+    from calibre_plugins.caps.config import prefs
+
+    if elasticsearch_process is None and prefs['elasticsearch_launch_path']:
+        process = node_lifecycle.attach(_url)
+        if process:
+            elasticsearch_process = process
+            if os.name == 'nt':
+                elasticsearch_subprocess = process
+            launch_path = prefs['elasticsearch_launch_path']
+            _register_shutdown_hook()
+
+class LogTail(object):
+
+    # Follows the log files of the node from where they ended before launch
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.offsets = {}
+        for path in self._log_files():
+            try:
+                self.offsets[path] = os.path.getsize(path)
+            except OSError:
+                pass
+
+    def _log_files(self):
+        return glob.glob(os.path.join(self.log_dir, '*.log'))
+
+    def poll(self):
+        # Returns (started, error line or None) for what was logged since
+        # the last call
+        started = False
+        for path in self._log_files():
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(self.offsets.get(path, 0))
+                    data = f.read()
+            except (IOError, OSError):
+                continue
+            # Only complete lines, the rest is read again next time
+            end = data.rfind(b'\n') + 1
+            self.offsets[path] = self.offsets.get(path, 0) + end
+            for line in data[:end].decode('utf-8', 'replace').splitlines():
+                if NODE_FAILED_RE.search(line):
+                    return started, line.strip()
+                if NODE_STARTED_RE.search(line):
+                    started = True
+        return started, None
+
+def wait_until_ready(elastic_search_client, index=None, timeout=LAUNCH_TIMEOUT):
+    # Waits until the library index, or the whole cluster when it has no
+    # index yet, can serve searches
+    deadline = time.time() + timeout
+    delay = READY_POLL_MIN
+    while True:
+        remaining = max(1, int(deadline - time.time()))
+        try:
+            target = index if index and elastic_search_client.indices.exists(index=index) else None
+            res = elastic_search_client.cluster.health(
+                index=target,
+                wait_for_status='yellow',
+                timeout='{}s'.format(remaining),
+                request_timeout=remaining + 5,
+                filter_path='status,timed_out')
+            return not res.get('timed_out') and res.get('status') in ('yellow', 'green')
+        except Exception:
+            if time.time() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, READY_POLL_MAX)
+
+
 def worker(hwnd, lParam):
     pid = ctypes.wintypes.DWORD()
     user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
@@ -84,6 +246,9 @@ def minimize(process):
         raise ctypes.WinError()
 
 
+class LaunchError(Exception):
+    pass
+
 class Launcher(QtCore.QRunnable):
 
     @pyqtSlot()
@@ -95,7 +260,14 @@ class Launcher(QtCore.QRunnable):
         global msgbox
         global ok
 
+        from calibre_plugins.caps.config import prefs
+
+        # A node kept warm for the next session must not go down with Calibre's
+        # process group or console
+        detach = prefs['elasticsearch_idle_minutes'] > 0
+
         try:
+            log_tail = LogTail(os.path.join(launch_path, 'logs'))
 
             if os.name == 'nt':
                 service_control_script = os.path.join(launch_path, 'bin', 'elasticsearch-service.bat')
@@ -109,22 +281,32 @@ class Launcher(QtCore.QRunnable):
                     else:
                         elasticsearch_process = None
                 else:
-                    elasticsearch_process = subprocess_popen([os.path.join(launch_path, 'bin', 'elasticsearch.exe'), '-d'], shell=True)
+                    elasticsearch_process = subprocess_popen([os.path.join(launch_path, 'bin', 'elasticsearch.exe'), '-d'], shell=True, env=node_lifecycle.get_launch_env(), detach=detach)
                     time.sleep(1)
                     children = list(psutil.Process(elasticsearch_process.pid).children(recursive=False))
                     if children:
                         elasticsearch_subprocess = children[0]
                         minimize(elasticsearch_subprocess)
             else:
-                elasticsearch_process = subprocess_popen([os.path.join(launch_path, 'bin', 'elasticsearch')])
+                elasticsearch_process = subprocess_popen([os.path.join(launch_path, 'bin', 'elasticsearch')], env=node_lifecycle.get_launch_env(), detach=detach)
 
-            atexit.register(terminate_elasticsearch_process)
+            if elasticsearch_process:
+                node_lifecycle.record_launch((elasticsearch_subprocess or elasticsearch_process).pid, url, launch_path)
+            _register_shutdown_hook()
+            elastic_search_client = _get_shared_client(url)
             start_time = time.time()
-            while msgbox is not None and time.time() - start_time < 60:
-                elastic_search_client = Elasticsearch([url], timeout=60.0)
-                if elastic_search_client.ping(params={'request_timeout': 2.0}):
+            delay = READY_POLL_MIN
+            while msgbox is not None and time.time() - start_time < LAUNCH_TIMEOUT:
+                started, error = log_tail.poll()
+                if error:
+                    raise LaunchError(error)
+                if elastic_search_client.ping(params={'request_timeout': 1.0}):
                     break
-                time.sleep(1)
+                if started:
+                    # The node is up, the HTTP layer follows within moments
+                    delay = READY_POLL_MIN
+                time.sleep(delay)
+                delay = min(delay * 2, READY_POLL_MAX)
 
             if msgbox:
                 QtWidgets.QDialog.reject(msgbox)
@@ -134,6 +316,8 @@ class Launcher(QtCore.QRunnable):
             time.sleep(0.1)
             if msgbox:
                 msgbox.reason = 'Could not start ElasticSearch service. Please go to Options dialog and check your configuration.'
+                if isinstance(ex, LaunchError):
+                    msgbox.reason += '\n\n{}'.format(ex)
                 QtWidgets.QDialog.reject(msgbox)
 
 class LaunchMessageBox(QtWidgets.QDialog):
@@ -173,16 +357,21 @@ class LaunchMessageBox(QtWidgets.QDialog):
         QtWidgets.QDialog.reject(self)
 
 
-def get_elasticsearch_client(parent, title, _url, _launch_path):
+def get_elasticsearch_client(parent, title, _url, _launch_path, index=None):
     global url
     global launch_path
     global msgbox
     global ok
 
     reason = None
-    elastic_search_client = Elasticsearch([_url], timeout=60.0)
-
-    if not elastic_search_client.ping(params={'request_timeout': 2.0}):
+    elastic_search_client = _get_shared_client(_url)
+    if healthy and not node_lifecycle.node_gone():
+        return (elastic_search_client, reason)
+
+    if elastic_search_client.ping(params={'request_timeout': 2.0}):
+        # Possibly left running by an earlier session
+        _attach_elasticsearch_process(_url)
+    else:
         if _launch_path:
             if os.path.isdir(_launch_path):
                 url = _url
@@ -205,28 +394,27 @@ def get_elasticsearch_client(parent, title, _url, _launch_path):
             reason = 'Could not connect to ElasticSearch. Please make sure that it\'s running or go to Options dialog and provide a valid path to ElasticSearch.'
 
     if elastic_search_client:
-        ok = False
-        start_time = time.time()
-
-        while time.time() - start_time < 60:
-            try:
-                req = {
-                    '_source': False,
-                    'query': {
-                        'simple_query_string': {
-                            'query': '3f55fa2b-79ac-4f40-9244-6c0d7cbaa416'
-                        }
-                    }
-                }
-                elastic_search_client.search(index='library', body=json.dumps(req), ignore=[404])
-                ok = True
-                break
-
-            except Exception as ex:
-                time.sleep(1)
-
+        ok = wait_until_ready(elastic_search_client, index)
         if not ok:
             elastic_search_client = None
             reason = 'Timed out waiting for ElasticSearch to start.'
 
+    _set_health(elastic_search_client is not None)
     return (elastic_search_client, reason)
+
+def get_running_elasticsearch_client(_url):
+    elastic_search_client = _get_shared_client(_url)
+    if healthy and not node_lifecycle.node_gone():
+        return elastic_search_client
+    if failed_at is not None and time.time() - failed_at < HEALTH_RETRY_INTERVAL:
+        return None
+
+    try:
+        if elastic_search_client.ping(params={'request_timeout': 2.0}):
+            _attach_elasticsearch_process(_url)
+            _set_health(True)
+            return elastic_search_client
+    except Exception:
+        pass
+    _set_health(False)
+    return None
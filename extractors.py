@@ -0,0 +1,193 @@
+import codecs
+import contextlib
+import posixpath
+import re
+import threading
+import xml.etree.ElementTree as ET
+import zipfile
+from timeit import default_timer as timer
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+TITLE = 'Power Search'
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+DECLARED_ENCODING_RE = re.compile(br'''^<\?xml[^>]+encoding\s*=\s*["']([-\w.:]+)["']|<meta[^>]+charset\s*=\s*["']?([-\w.:]+)''', re.IGNORECASE)
+
+INVISIBLE_RE = re.compile(r'<(head|script|style)\b.*?</\1\s*>|<!--.*?-->|<!\[CDATA\[.*?\]\]>', re.IGNORECASE | re.DOTALL)
+BLOCK_TAG_RE = re.compile(r'</?(?:p|div|br|h[1-6]|li|tr|td|th|blockquote|pre|section|article|dd|dt|hr)\b[^>]*>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+SPACES_RE = re.compile(r'[ \t\r\f\v]+')
+
+FB2_BLOCK_TAGS = {'p', 'v', 'subtitle', 'text-author', 'td', 'th'}
+
+
+def decode(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding, 'replace')
+
+    match = DECLARED_ENCODING_RE.search(data[:1024])
+    if match:
+        try:
+            return data.decode((match.group(1) or match.group(2)).decode('ascii'), 'replace')
+        except LookupError:
+            pass
+
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+
+    try:
+        from calibre.ebooks.chardet import detect
+        encoding = detect(data[:65536]).get('encoding')
+        if encoding:
+            return data.decode(encoding, 'replace')
+    except Exception:
+        pass
+
+    return data.decode('cp1252', 'replace')
+
+def local_name(elem):
+    return elem.tag.rsplit('}', 1)[-1] if isinstance(elem.tag, str) else None
+
+def strip_tags(markup):
+    markup = INVISIBLE_RE.sub(' ', markup)
+    markup = BLOCK_TAG_RE.sub('\n', markup)
+    text = unescape(TAG_RE.sub('', markup))
+    lines = (SPACES_RE.sub(' ', line).strip() for line in text.splitlines())
+    return [line + '\n' for line in lines if line]
+
+
+def extract_txt(input):
+    with open(input, 'rb') as f:
+        return decode(f.read()).splitlines(True)
+
+def extract_html(input):
+    with open(input, 'rb') as f:
+        return strip_tags(decode(f.read()))
+
+def extract_epub(input):
+    content = []
+    with zipfile.ZipFile(input) as archive:
+        container = ET.fromstring(archive.read('META-INF/container.xml'))
+        opf_path = [elem for elem in container.iter() if local_name(elem) == 'rootfile'][0].get('full-path')
+        opf = ET.fromstring(archive.read(opf_path))
+        base = posixpath.dirname(opf_path)
+
+        manifest = {}
+        spine = []
+        for elem in opf.iter():
+            if local_name(elem) == 'item':
+                manifest[elem.get('id')] = (elem.get('href'), elem.get('media-type', ''))
+            elif local_name(elem) == 'itemref':
+                spine.append(elem.get('idref'))
+
+        for idref in spine:
+            href, media_type = manifest.get(idref, (None, None))
+            if not href or 'html' not in media_type:
+                continue
+            name = posixpath.normpath(posixpath.join(base, unquote(href.split('#', 1)[0])))
+            try:
+                data = archive.read(name)
+            except KeyError:
+                continue
+            content += strip_tags(decode(data))
+
+    return content
+
+def extract_fb2(input):
+    content = []
+    body_depth = 0
+    for event, elem in ET.iterparse(input, events=('start', 'end')):
+        tag = local_name(elem)
+        if event == 'start':
+            if tag == 'body':
+                body_depth += 1
+            continue
+
+        if tag == 'body':
+            body_depth -= 1
+        elif body_depth and tag in FB2_BLOCK_TAGS:
+            text = SPACES_RE.sub(' ', ''.join(elem.itertext())).strip()
+            if text:
+                content.append(text + '\n')
+            elem.clear()
+        elif tag == 'binary':
+            # Embedded images are base64 blobs; drop them as soon as parsed
+            elem.clear()
+
+    return content
+
+
+class ExtractorRegistry(object):
+
+    def __init__(self):
+        self.extractors = {}
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def register(self, formats, name, fn):
+        for format in formats:
+            self.extractors[format] = (name, fn)
+
+    def extract(self, input, format):
+        # Returns a list of lines, or None when the book should go through
+        # the regular conversion instead
+        if format not in self.extractors:
+            return None
+
+        name, fn = self.extractors[format]
+        try:
+            with self.timer(name):
+                content = fn(input)
+        except Exception as ex:
+            print('{}> {} extractor failed on {}: {}'.format(TITLE, name, input, ex))
+            return None
+
+        return content or None
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - start
+            with self.lock:
+                count, total = self.timings.get(name, (0, 0.0))
+                self.timings[name] = (count + 1, total + elapsed)
+
+    def reset_timings(self):
+        with self.lock:
+            self.timings = {}
+
+    def print_timings(self):
+        with self.lock:
+            timings = sorted(self.timings.items())
+        for name, (count, total) in timings:
+            print('{}> Extractor {}: {} books in {:.2f}s, {:.3f}s per book'.format(TITLE, name, count, total, total / count))
+
+
+extractor_registry = ExtractorRegistry()
+extractor_registry.register(['EPUB'], 'epub', extract_epub)
+extractor_registry.register(['FB2'], 'fb2', extract_fb2)
+extractor_registry.register(['TXT'], 'txt', extract_txt)
+extractor_registry.register(['HTML', 'HTM', 'XHTML'], 'html', extract_html)
@@ -0,0 +1,25 @@
+import hashlib
+import os
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def _new_hash():
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.sha1()
+
+def content_hash(path, algorithm=None):
+    h = hashlib.new(algorithm) if algorithm else _new_hash()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+# Size plus content hash: unchanged bytes keep the fingerprint even when
+# Calibre touches the file's mtime
+def fingerprint(path):
+    digest = content_hash(path)
+    return '{}:{}'.format(os.path.getsize(path), digest), digest
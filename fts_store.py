@@ -0,0 +1,332 @@
+import os
+import re
+import sqlite3
+import threading
+
+TITLE = 'Power Search'
+
+FTS_FILE_NAME = 'caps-fts.sqlite'
+
+# Stemmed, case and accent insensitive words, close to what the standard
+# analyzer of ElasticSearch finds
+FTS_TOKENIZER = 'porter unicode61 remove_diacritics 2'
+
+# Prefix queries ('math*') on short prefixes would otherwise merge the posting
+# lists of thousands of words
+FTS_PREFIX_LENGTHS = '2 3'
+
+# Characters that end a word in a query
+QUERY_DELIMITERS = '()|"'
+
+WILDCARD_RE = re.compile(r'[*?]')
+WORD_RE = re.compile(r'\w', re.UNICODE)
+
+
+class UnsupportedQueryError(ValueError):
+    pass
+
+# The simple_query_string syntax described in USAGE.txt is parsed into a tree
+# of ('match', <FTS5 expression>), ('and', [...]), ('or', [...]) and
+# ('not', <node>) nodes. Terms the tokenizer would drop leave no node at all
+
+def _tokenize(text):
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c == '"':
+            end = text.find('"', i + 1)
+            if end < 0:
+                end = len(text)
+            tokens.append(('phrase', text[i + 1:end]))
+            i = end + 1
+        elif c in '()|+-':
+            tokens.append((c, None))
+            i += 1
+        elif c == '/' and text.find('/', i + 1) > 0:
+            raise UnsupportedQueryError('Regular expressions are not supported by the built-in search engine')
+        else:
+            end = i
+            while end < len(text) and not text[end].isspace() and text[end] not in QUERY_DELIMITERS:
+                end += 1
+            tokens.append(('term', text[i:end]))
+            i = end
+    return tokens
+
+def _quote(words):
+    return '"{}"'.format(words.replace('"', '""'))
+
+def _term(word):
+    # Fuzziness and slop ('~N') have no equivalent, the word is taken as is
+    word = word.split('~')[0]
+    wildcard = WILDCARD_RE.search(word)
+    if wildcard:
+        # FTS5 only knows prefix queries, so 'te?t' and 'te*t' both become 'te*'
+        if wildcard.start() == 0:
+            raise UnsupportedQueryError('Words starting with a wildcard are not supported by the built-in search engine')
+        word = word[:wildcard.start()]
+    if not WORD_RE.search(word):
+        return None
+    return ('match', _quote(word) + ('*' if wildcard else ''))
+
+def _phrase(words):
+    if not WORD_RE.search(words):
+        return None
+    return ('match', _quote(words))
+
+class _Parser(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def parse(self):
+        node = self.parse_or()
+        # Unbalanced closing brackets are ignored
+        while self.peek() is not None:
+            self.take()
+            node = _combine('and', [node, self.parse_or()])
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == '|':
+            self.take()
+            nodes.append(self.parse_and())
+        return _combine('or', nodes)
+
+    def parse_and(self):
+        nodes = []
+        while self.peek() not in (None, ')', '|'):
+            if self.peek() == '+':
+                self.take()
+                continue
+            nodes.append(self.parse_unary())
+        return _combine('and', nodes)
+
+    def parse_unary(self):
+        if self.peek() == '-':
+            self.take()
+            if self.peek() in (None, ')', '|'):
+                return None
+            node = self.parse_unary()
+            return ('not', node) if node else None
+        if self.peek() == '+':
+            self.take()
+            return self.parse_unary() if self.peek() not in (None, ')', '|') else None
+
+        kind, value = self.take()
+        if kind == '(':
+            node = self.parse_or()
+            if self.peek() == ')':
+                self.take()
+            return node
+        if kind == 'phrase':
+            return _phrase(value)
+        if kind == 'term':
+            return _term(value)
+        return None
+
+def _combine(op, nodes):
+    nodes = [node for node in nodes if node]
+    if not nodes:
+        return None
+    if len(nodes) == 1 and nodes[0][0] != 'not':
+        return nodes[0]
+    return (op, nodes)
+
+def parse_query(text):
+    return _Parser(_tokenize(text)).parse()
+
+# Whatever one FTS5 expression can say is matched in one go. Only negations
+# without anything positive next to them ('-bad', 'good | -bad') need the set
+# of all documents, which plain SQL set operations provide
+
+ALL_DOCS = 'SELECT rowid AS doc FROM fts_docs'
+MATCH_DOCS = 'SELECT rowid AS doc FROM fts_content WHERE fts_content MATCH ?'
+
+def _sql(compiled):
+    if compiled[0] == 'match':
+        return MATCH_DOCS, [compiled[1]]
+    return compiled[1], compiled[2]
+
+def _set_operation(operator, operands):
+    sql = []
+    params = []
+    for curr in operands:
+        curr_sql, curr_params = _sql(curr)
+        sql.append('SELECT doc FROM ({})'.format(curr_sql))
+        params += curr_params
+    return ('sql', ' {} '.format(operator).join(sql), params)
+
+def _compile(node):
+    op = node[0]
+    if op == 'match':
+        return node
+    if op == 'not':
+        return _compile(('and', [node]))
+
+    children = node[1]
+    if op == 'or':
+        compiled = [_compile(('and', [curr])) if curr[0] == 'not' else _compile(curr) for curr in children]
+        if all(curr[0] == 'match' for curr in compiled):
+            return ('match', ' OR '.join('({})'.format(curr[1]) for curr in compiled))
+        return _set_operation('UNION', compiled)
+
+    positive = [_compile(curr) for curr in children if curr[0] != 'not']
+    negative = [_compile(curr[1]) for curr in children if curr[0] == 'not']
+    if positive and all(curr[0] == 'match' for curr in positive + negative):
+        expr = ' AND '.join('({})'.format(curr[1]) for curr in positive)
+        for curr in negative:
+            expr = '({}) NOT ({})'.format(expr, curr[1])
+        return ('match', expr)
+
+    if positive:
+        compiled = _set_operation('INTERSECT', positive) if len(positive) > 1 else positive[0]
+    else:
+        compiled = ('sql', ALL_DOCS, [])
+    for curr in negative:
+        compiled = _set_operation('EXCEPT', [compiled, curr])
+    return compiled
+
+def compile_query(text):
+    # Returns SQL selecting the rowid of every matching document as 'doc' and
+    # its parameters, or None when the text has nothing to search for
+    node = parse_query(text)
+    if node is None:
+        return None
+    return _sql(_compile(node))
+
+
+class FtsStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # One row per book format; the text lives in fts_content under the
+        # same rowid
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fts_docs ('
+            ' rowid INTEGER PRIMARY KEY,'
+            ' library_id TEXT NOT NULL,'
+            ' book_id INTEGER NOT NULL,'
+            ' format TEXT NOT NULL,'
+            ' UNIQUE (library_id, book_id, format)'
+            ')')
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS fts_content USING fts5(metadata, content, tokenize='{}', prefix='{}')".format(
+                FTS_TOKENIZER, FTS_PREFIX_LENGTHS))
+        self.conn.commit()
+
+    def _reader(self):
+        # Searches run on worker threads, each with its own connection, so
+        # they never wait for an indexing run holding the writer
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute('PRAGMA query_only=1')
+            self.local.conn = conn
+        return conn
+
+    def index(self, library_id, book_id, format, metadata, content):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT rowid FROM fts_docs WHERE library_id = ? AND book_id = ? AND format = ?',
+                (library_id, book_id, format)).fetchone()
+            if row:
+                rowid = row[0]
+                self.conn.execute('DELETE FROM fts_content WHERE rowid = ?', (rowid,))
+            else:
+                rowid = self.conn.execute(
+                    'INSERT INTO fts_docs (library_id, book_id, format) VALUES (?, ?, ?)',
+                    (library_id, book_id, format)).lastrowid
+            self.conn.execute(
+                'INSERT INTO fts_content (rowid, metadata, content) VALUES (?, ?, ?)', (rowid, metadata, content))
+
+    def delete(self, library_id, book_id, format):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT rowid FROM fts_docs WHERE library_id = ? AND book_id = ? AND format = ?',
+                (library_id, book_id, format)).fetchone()
+            if row:
+                self.conn.execute('DELETE FROM fts_content WHERE rowid = ?', (row[0],))
+                self.conn.execute('DELETE FROM fts_docs WHERE rowid = ?', (row[0],))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.conn.rollback()
+
+    def _clear(self, library_id):
+        self.conn.execute(
+            'DELETE FROM fts_content WHERE rowid IN (SELECT rowid FROM fts_docs WHERE library_id = ?)', (library_id,))
+        self.conn.execute('DELETE FROM fts_docs WHERE library_id = ?', (library_id,))
+
+    def clear(self, library_id):
+        with self.lock:
+            self.conn.commit()
+            with self.conn:
+                self._clear(library_id)
+
+    # Makes the documents indexed under staging_id, while the library was
+    # being rebuilt, the documents of the library
+    def replace(self, library_id, staging_id):
+        with self.lock:
+            self.conn.commit()
+            with self.conn:
+                self._clear(library_id)
+                self.conn.execute('UPDATE fts_docs SET library_id = ? WHERE library_id = ?', (library_id, staging_id))
+
+    def optimize(self):
+        with self.lock:
+            self.conn.commit()
+            with self.conn:
+                self.conn.execute("INSERT INTO fts_content (fts_content) VALUES ('optimize')")
+
+    # Ids of the books of the library with a format matching the text
+    def book_ids(self, library_id, text):
+        query = compile_query(text)
+        if query is None:
+            return []
+        sql, params = query
+        rows = self._reader().execute(
+            'SELECT DISTINCT book_id FROM fts_docs WHERE library_id = ? AND rowid IN ({})'.format(sql),
+            [library_id] + params).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, library_id, text):
+        query = compile_query(text)
+        if query is None:
+            return 0
+        sql, params = query
+        return self._reader().execute(
+            'SELECT COUNT(DISTINCT book_id) FROM fts_docs WHERE library_id = ? AND rowid IN ({})'.format(sql),
+            [library_id] + params).fetchone()[0]
+
+
+_store = None
+
+def get_fts_store():
+    global _store
+
+    if _store is None:
+        from calibre_plugins.caps.config import prefs
+        _store = FtsStore(os.path.join(os.path.dirname(prefs.file_path), FTS_FILE_NAME))
+
+    return _store
@@ -0,0 +1,241 @@
+import threading
+
+from calibre_plugins.caps.elasticsearch.exceptions import NotFoundError
+from calibre_plugins.caps.search_helper import BACKFILL_SCRIPT, check_server_version
+
+TITLE = 'Power Search'
+
+# Bump whenever INDEX_MAPPINGS or INDEX_SETTINGS change, existing indices
+# are then copied into a new version on the next indexing run
+INDEX_MAPPING_VERSION = 1
+
+UPGRADE_REQUEST_TIMEOUT = 3600
+FORCEMERGE_REQUEST_TIMEOUT = 3600
+
+# Applied for the duration of large indexing runs: no periodic refreshes,
+# translog fsync in the background and no replicas to copy every write to
+BULK_LOAD_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.translog.durability': 'async',
+    'index.number_of_replicas': 0
+}
+
+INDEX_SETTINGS = {
+    'number_of_shards': 1,
+    'codec': 'best_compression',
+    # Searches without explicit fields only look at the text
+    'query.default_field': ['content', 'metadata']
+}
+
+INDEX_MAPPINGS = {
+    '_meta': {'caps_mapping_version': INDEX_MAPPING_VERSION},
+    'dynamic': False,
+    'properties': {
+        'book_id': {'type': 'integer'},
+        'format': {'type': 'keyword'},
+        # Relevance is never used, so length norms are dead weight
+        'metadata': {'type': 'text', 'norms': False},
+        'content': {'type': 'text', 'norms': False}
+    }
+}
+
+
+def _index_body(client):
+    settings = dict(INDEX_SETTINGS)
+    # Replicas can never be allocated on a single node, they only keep the
+    # cluster yellow
+    if client.cluster.health(filter_path='number_of_data_nodes').get('number_of_data_nodes', 1) <= 1:
+        settings['number_of_replicas'] = 0
+    return {'settings': {'index': settings}, 'mappings': INDEX_MAPPINGS}
+
+def get_mapping_version(client, index):
+    # None when the index does not exist, 0 for indices created by dynamic mapping
+    try:
+        res = client.indices.get_mapping(index=index)
+    except NotFoundError:
+        return None
+    for curr in res.values():
+        return curr.get('mappings', {}).get('_meta', {}).get('caps_mapping_version', 0)
+    return None
+
+def create_index(client, index):
+    print('{}> Create index {}'.format(TITLE, index))
+    client.indices.create(index=index, body=_index_body(client))
+
+# Every library index is a versioned index (<alias>-v<N>) reached through an
+# alias named after the library. Rebuilds and upgrades fill the next version
+# while searches keep using the current one, then move the alias over
+
+def _versioned_name(alias, version):
+    return '{}-v{}'.format(alias, version)
+
+def _versions(client, alias):
+    # Maps every versioned index of the library to its version number
+    res = client.indices.get_alias(index='{}-v*'.format(alias))
+    prefix = '{}-v'.format(alias)
+    return {index: int(index[len(prefix):]) for index in res if index[len(prefix):].isdigit()}
+
+def get_live_index(client, alias):
+    # The index searches go to: the one the alias points at, an index created
+    # before aliases were used, or None
+    try:
+        res = client.indices.get_alias(name=alias)
+        for index in sorted(res):
+            return index
+    except NotFoundError:
+        pass
+    if client.indices.exists(index=alias):
+        return alias
+    return None
+
+def discard_unfinished_indices(client, alias):
+    # Versions that never went live are left over by interrupted rebuilds.
+    # Returns the versions that remain
+    live = get_live_index(client, alias)
+    versions = _versions(client, alias)
+    for index in list(versions):
+        if index != live:
+            print('{}> Delete unfinished index {}'.format(TITLE, index))
+            client.indices.delete(index=index, ignore=[404])
+            _forget_bulk_load(index)
+            del versions[index]
+    return versions
+
+def next_index_name(client, alias):
+    versions = discard_unfinished_indices(client, alias)
+    return _versioned_name(alias, max(list(versions.values()) + [0]) + 1)
+
+def create_next_index(client, alias):
+    index = next_index_name(client, alias)
+    create_index(client, index)
+    return index
+
+def switch_alias(client, alias, index):
+    # Atomically moves the alias to the given index, the previous index is
+    # deleted afterwards
+    live = get_live_index(client, alias)
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if live == alias:
+        # An index cannot share its name with an alias
+        actions.append({'remove_index': {'index': live}})
+    elif live and live != index:
+        actions.append({'remove': {'index': live, 'alias': alias}})
+    print('{}> Switch {} to index {}'.format(TITLE, alias, index))
+    client.indices.update_aliases(body={'actions': actions})
+
+    if live and live not in (alias, index):
+        client.indices.delete(index=live, ignore=[404])
+
+def delete_library_index(client, alias):
+    live = get_live_index(client, alias)
+    if live == alias:
+        client.indices.delete(index=alias, ignore=[404])
+    for index in _versions(client, alias):
+        client.indices.delete(index=index, ignore=[404])
+        _forget_bulk_load(index)
+    _forget_bulk_load(alias)
+
+def ensure_index(client, alias):
+    # Returns False when the index exists with an outdated mapping
+    check_server_version(client)
+    live = get_live_index(client, alias)
+    if live is None:
+        switch_alias(client, alias, create_next_index(client, alias))
+        return True
+    discard_unfinished_indices(client, alias)
+    return get_mapping_version(client, live) >= INDEX_MAPPING_VERSION
+
+def _copy_index(client, source, dest):
+    client.reindex(
+        body={
+            'source': {'index': source},
+            'dest': {'index': dest},
+            # Documents indexed before book_id and format were stored
+            'script': {'source': 'if (ctx._source.book_id == null) {' + BACKFILL_SCRIPT + '}', 'lang': 'painless'}
+        },
+        refresh=True,
+        wait_for_completion=True,
+        request_timeout=UPGRADE_REQUEST_TIMEOUT)
+
+def upgrade_index(client, alias):
+    # Copies the documents into a new version created with the current
+    # mapping, so already extracted text does not have to be converted again
+    print('{}> Upgrade mapping of index {}'.format(TITLE, alias))
+    live = get_live_index(client, alias)
+    index = create_next_index(client, alias)
+    try:
+        _copy_index(client, live, index)
+    except Exception:
+        # The alias stays on the old index, the next run tries again
+        client.indices.delete(index=index, ignore=[404])
+        raise
+    switch_alias(client, alias, index)
+
+def clone_into_library_index(client, source, alias):
+    index = next_index_name(client, alias)
+    client.indices.put_settings(body={'index.blocks.write': True}, index=source)
+    try:
+        client.indices.clone(source, index, body={'settings': {'index.blocks.write': None}})
+    except Exception:
+        # The old index is left as it was for the next attempt
+        client.indices.put_settings(body={'index.blocks.write': None}, index=source, ignore=[404])
+        raise
+    switch_alias(client, alias, index)
+    client.indices.delete(index=source, ignore=[404])
+
+def begin_bulk_load(client, index):
+    from calibre_plugins.caps.config import prefs
+
+    saved = dict(prefs['bulk_load_restore'])
+    if index not in saved:
+        res = client.indices.get_settings(index=index, name=','.join(BULK_LOAD_SETTINGS), flat_settings=True)
+        current = {}
+        for curr in res.values():
+            current = curr.get('settings', {})
+        # Settings that were never set are restored to their defaults by None.
+        # The originals are saved before the index is touched, so a crash in
+        # the middle of the run is undone by the next end_bulk_load()
+        saved[index] = {name: current.get(name) for name in BULK_LOAD_SETTINGS}
+        prefs['bulk_load_restore'] = saved
+
+    print('{}> Switch index {} to bulk load settings'.format(TITLE, index))
+    client.indices.put_settings(index=index, body=BULK_LOAD_SETTINGS)
+
+def end_bulk_load(client, index):
+    # Returns True when bulk load settings had to be restored
+    from calibre_plugins.caps.config import prefs
+
+    saved = dict(prefs['bulk_load_restore'])
+    if index not in saved:
+        return False
+
+    print('{}> Restore settings of index {}'.format(TITLE, index))
+    try:
+        client.indices.put_settings(index=index, body=saved[index])
+        client.indices.refresh(index=index)
+    except NotFoundError:
+        pass
+
+    _forget_bulk_load(index)
+    return True
+
+def _forget_bulk_load(index):
+    from calibre_plugins.caps.config import prefs
+
+    saved = dict(prefs['bulk_load_restore'])
+    if saved.pop(index, None) is not None:
+        prefs['bulk_load_restore'] = saved
+
+def optimize_index(client, index):
+    # Merging a freshly built index down to one segment takes minutes on
+    # large libraries, so it is left to run on its own
+    def run():
+        try:
+            client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=FORCEMERGE_REQUEST_TIMEOUT)
+            print('{}> Optimized index {}'.format(TITLE, index))
+        except Exception as ex:
+            print('{}> Could not optimize index {}: {}'.format(TITLE, index, ex))
+
+    thread = threading.Thread(target=run, name='caps-forcemerge')
+    thread.daemon = True
+    thread.start()
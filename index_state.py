@@ -0,0 +1,166 @@
+import datetime
+import dateutil.tz
+import os
+import sqlite3
+import threading
+
+TITLE = 'Power Search'
+
+INDEX_STATE_FILE_NAME = 'caps-index-state.sqlite'
+
+# Number of buffered writes after which the open transaction is committed
+COMMIT_BATCH_SIZE = 500
+
+# Stay well below SQLite's limit of host parameters per statement
+QUERY_BATCH_SIZE = 500
+
+EPOCH = datetime.datetime(1970, 1, 1, 0, 0, tzinfo=dateutil.tz.tzutc())
+
+
+def _to_micros(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=dateutil.tz.tzutc())
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _from_micros(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class IndexStateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS index_state ('
+            ' library_id TEXT NOT NULL,'
+            ' book_id INTEGER NOT NULL,'
+            ' format TEXT NOT NULL,'
+            ' last_modified INTEGER NOT NULL,'
+            ' fingerprint TEXT,'
+            ' PRIMARY KEY (library_id, book_id, format)'
+            ') WITHOUT ROWID')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(index_state)')]
+        if 'fingerprint' not in columns:
+            self.conn.execute('ALTER TABLE index_state ADD COLUMN fingerprint TEXT')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS index_generation ('
+            ' library_id TEXT PRIMARY KEY,'
+            ' generation INTEGER NOT NULL'
+            ')')
+        self.conn.commit()
+
+    # Maps (book_id, format) to a (last_modified, fingerprint) tuple, either
+    # for the whole library or for the given books only
+    def load(self, library_id, book_ids=None):
+        with self.lock:
+            if book_ids is None:
+                rows = self.conn.execute(
+                    'SELECT book_id, format, last_modified, fingerprint FROM index_state WHERE library_id = ?',
+                    (library_id,)).fetchall()
+            else:
+                rows = []
+                book_ids = list(book_ids)
+                for i in range(0, len(book_ids), QUERY_BATCH_SIZE):
+                    batch = book_ids[i:i + QUERY_BATCH_SIZE]
+                    rows += self.conn.execute(
+                        'SELECT book_id, format, last_modified, fingerprint FROM index_state WHERE library_id = ? AND book_id IN ({})'.format(
+                            ','.join('?' * len(batch))),
+                        [library_id] + batch).fetchall()
+        return {(book_id, format): (_from_micros(last_modified), fingerprint) for book_id, format, last_modified, fingerprint in rows}
+
+    def get(self, library_id, book_id, format):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT last_modified, fingerprint FROM index_state WHERE library_id = ? AND book_id = ? AND format = ?',
+                (library_id, book_id, format)).fetchone()
+        return (_from_micros(row[0]), row[1]) if row else None
+
+    def set(self, library_id, book_id, format, last_modified, fingerprint=None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO index_state (library_id, book_id, format, last_modified, fingerprint) VALUES (?, ?, ?, ?, ?)',
+                (library_id, book_id, format, _to_micros(last_modified), fingerprint))
+            self._written()
+
+    def delete(self, library_id, book_id, format):
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM index_state WHERE library_id = ? AND book_id = ? AND format = ?',
+                (library_id, book_id, format))
+            self._written()
+
+    def clear(self, library_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM index_state WHERE library_id = ?', (library_id,))
+            self.commit()
+
+    # Makes the state collected under staging_id, while a new index was
+    # being built, the state of the library
+    def replace(self, library_id, staging_id):
+        with self.lock:
+            self.commit()
+            with self.conn:
+                self.conn.execute('DELETE FROM index_state WHERE library_id = ?', (library_id,))
+                self.conn.execute('UPDATE index_state SET library_id = ? WHERE library_id = ?', (library_id, staging_id))
+
+    # Counts changes to the library index; anything derived from search
+    # results is only valid for the generation it was computed at
+    def generation(self, library_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT generation FROM index_generation WHERE library_id = ?', (library_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_generation(self, library_id):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO index_generation (library_id, generation) VALUES (?, ?)',
+                (library_id, self.generation(library_id) + 1))
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def _written(self):
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_BATCH_SIZE:
+            self.commit()
+
+    def migrate_from_prefs(self, prefs, library_id):
+        legacy = prefs.get(library_id, {}).get('index_state')
+        if legacy is None:
+            return
+
+        print('{}> Migrate {} index state entries of library {}'.format(TITLE, len(legacy), library_id))
+        with self.lock:
+            self.commit()
+            with self.conn:
+                for key, last_modified in legacy.items():
+                    book_id, format = key.split(':', 1)
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO index_state (library_id, book_id, format, last_modified) VALUES (?, ?, ?, ?)',
+                        (library_id, int(book_id), format, _to_micros(last_modified)))
+
+        # Only drop the legacy copy once the rows are safely committed
+        del prefs[library_id]['index_state']
+        prefs.commit()
+
+
+_store = None
+
+def get_index_state_store():
+    global _store
+
+    if _store is None:
+        from calibre_plugins.caps.config import prefs
+        _store = IndexStateStore(os.path.join(os.path.dirname(prefs.file_path), INDEX_STATE_FILE_NAME))
+
+    return _store
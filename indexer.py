@@ -0,0 +1,175 @@
+import queue
+
+from calibre_plugins.caps.elasticsearch.helpers import streaming_bulk
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, QRunnable
+
+TITLE = 'Power Search'
+
+BULK_CHUNK_SIZE = 200
+BULK_CHUNK_BYTES = 16 * 1024 * 1024
+BULK_QUEUE_SIZE = 64
+BULK_MAX_RETRIES = 3
+BULK_REQUEST_TIMEOUT = 120.0
+
+# Documents written to the built-in index per transaction
+FTS_COMMIT_BATCH_SIZE = 200
+
+_CLOSED = object()
+
+class IndexerSignals(QObject):
+    indexed = pyqtSignal(dict)
+    finished = pyqtSignal()
+
+class QueuedIndexer(QRunnable):
+    # Conversion workers put() documents, a single runnable writes them
+
+    def __init__(self, deletes=()):
+        super(QueuedIndexer, self).__init__()
+        self.deletes = list(deletes)
+        self.queue = queue.Queue(maxsize=BULK_QUEUE_SIZE)
+        self.closed = False
+        self.signals = IndexerSignals()
+
+    def put(self, id, doc, args):
+        # Blocks the calling conversion worker while the queue is full, so
+        # extraction never runs too far ahead of what the index can take
+        self.queue.put((id, doc, args))
+
+    # Reports a book that is not sent to the index, either because it
+    # failed to convert (ok=False) or because it did not change (ok=True)
+    def skip(self, args, ok=False):
+        self.queue.put((None, None, dict(args, ok=ok)))
+
+    def close(self):
+        self.queue.put(_CLOSED)
+
+    def _report(self, args, ok):
+        args = dict(args)
+        args['ok'] = ok
+        self.signals.indexed.emit(args)
+
+    def _next(self):
+        item = self.queue.get()
+        if item is _CLOSED:
+            self.closed = True
+            return None
+        return item
+
+    def _drain(self):
+        # Keeps the queue moving after a failure, so that no conversion
+        # worker stays blocked on a full queue
+        while not self.closed:
+            item = self._next()
+            if item is not None:
+                self._report(item[2], False)
+
+class BulkIndexer(QueuedIndexer):
+
+    def __init__(self, client, index, deletes=()):
+        super(BulkIndexer, self).__init__(deletes)
+        self.client = client
+        self.index = index
+        self.pending = {}
+
+    def _actions(self):
+        for id, args in self.deletes:
+            self.pending[id] = args
+            yield {'_op_type': 'delete', '_index': self.index, '_id': id}
+
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            id, doc, args = item
+            if doc is None:
+                self._report(args, args['ok'])
+                continue
+            self.pending[id] = args
+            yield {'_op_type': 'index', '_index': self.index, '_id': id, '_source': doc}
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            for ok, item in streaming_bulk(
+                    self.client,
+                    self._actions(),
+                    chunk_size=BULK_CHUNK_SIZE,
+                    max_chunk_bytes=BULK_CHUNK_BYTES,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                    max_retries=BULK_MAX_RETRIES,
+                    request_timeout=BULK_REQUEST_TIMEOUT):
+                op, info = item.popitem()
+                if op == 'delete' and info.get('status') == 404:
+                    ok = True
+                if not ok:
+                    print('{}> Book {} failed: {}'.format(TITLE, info.get('_id'), info.get('error')))
+                args = self.pending.pop(info.get('_id'), None)
+                if args is not None:
+                    self._report(args, ok)
+
+        except Exception as ex:
+            print('{}> {}'.format(TITLE, ex))
+
+        # Whatever was not acknowledged has failed
+        for args in self.pending.values():
+            self._report(args, False)
+        self.pending = {}
+        self._drain()
+
+        self.signals.finished.emit()
+
+class FtsIndexer(QueuedIndexer):
+    # Writes into the built-in SQLite full text index; books are reported
+    # once the transaction holding them is committed
+
+    def __init__(self, store, library_id, deletes=()):
+        super(FtsIndexer, self).__init__(deletes)
+        self.store = store
+        self.library_id = library_id
+        self.pending = []
+
+    def _commit(self):
+        self.store.commit()
+        for args in self.pending:
+            self._report(args, True)
+        self.pending = []
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            for _, args in self.deletes:
+                self.store.delete(self.library_id, args['book_id'], args['format'])
+                self.pending.append(args)
+            self._commit()
+
+            while True:
+                item = self._next()
+                if item is None:
+                    break
+                _, doc, args = item
+                if doc is None:
+                    self._report(args, args['ok'])
+                    continue
+                content = doc['content']
+                if isinstance(content, list):
+                    content = '\n'.join(content)
+                self.store.index(self.library_id, doc['book_id'], doc['format'], doc['metadata'], content)
+                self.pending.append(args)
+                if len(self.pending) >= FTS_COMMIT_BATCH_SIZE:
+                    self._commit()
+            self._commit()
+
+        except Exception as ex:
+            print('{}> {}'.format(TITLE, ex))
+            try:
+                self.store.rollback()
+            except Exception:
+                pass
+
+        for args in self.pending:
+            self._report(args, False)
+        self.pending = []
+        self._drain()
+
+        self.signals.finished.emit()
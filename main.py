@@ -1,22 +1,33 @@
 import datetime
 import dateutil.tz
 import functools
-import json
 import os
 import platform
+import shutil
 import sys
 import threading
-import time
 from timeit import default_timer as timer
 
 import calibre
 import calibre.ptempfile
 from calibre.utils.config_base import json_dumps
 from calibre_plugins.caps import CapsPlugin
-from calibre_plugins.caps.async_worker import AsyncWorker
+from calibre_plugins.caps.async_worker import AsyncWorker, TaskWorker
+from calibre_plugins.caps.calibre_fts import get_calibre_text_source
+from calibre_plugins.caps.change_tracker import ChangeTracker
+from calibre_plugins.caps.conversion_pool import get_conversion_pool
 from calibre_plugins.caps.config import prefs, ARCHIVE_FORMATS
-from calibre_plugins.caps.elasticsearch_helper import get_elasticsearch_client
+from calibre_plugins.caps.elasticsearch_helper import get_elasticsearch_client, get_running_elasticsearch_client
+from calibre_plugins.caps.extractors import extractor_registry
+from calibre_plugins.caps.fingerprint import fingerprint
+from calibre_plugins.caps.index_state import get_index_state_store
+from calibre_plugins.caps.index_helper import clone_into_library_index
+from calibre_plugins.caps.result_cache import get_result_cache
+from calibre_plugins.caps.search_backend import BACKEND_ELASTICSEARCH, BACKEND_SQLITE, ElasticsearchBackend, get_library_alias, get_sqlite_backend, get_state_id, has_unfinished_bulk_load
+from calibre_plugins.caps.search_worker import CountWorker, SearchWorker
+from calibre_plugins.caps.pdf_helper import get_pdfinfo_path, get_page_count, split_pages, pdftotext, pdftotext_page_ranges
 from calibre_plugins.caps.subprocess_helper import subprocess_call
+from calibre_plugins.caps.text_cache import get_text_cache
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.Qt import Qt
@@ -25,6 +36,20 @@ TITLE = 'Power Search'
 
 SEARCH_HISTORY_ITEMS = 10
 
+# Indexing runs with at least this many formats to index switch the index
+# to bulk load settings
+BULK_LOAD_MIN_BOOKS = 500
+
+# Index state of a rebuild in progress is collected under this id and only
+# replaces the library's state once the new index goes live
+REBUILD_STATE_ID = '{}:rebuild'
+
+# Minimum interval between updates of the marked books while results arrive
+SEARCH_PROGRESS_INTERVAL = 0.5
+
+# Typing pause after which the number of matching books is previewed
+PREVIEW_DELAY_MS = 300
+
 if False:
     get_resources = lambda x: x
     get_icons = lambda x: x
@@ -48,6 +73,11 @@ def which(program):
 def concat(book_id, format):
     return '{}:{}'.format(book_id, format)
 
+def read_lines(path):
+    if sys.version_info[0] >= 3:
+        return open(path, errors='ignore').readlines()
+    return open(path).readlines()
+
 class ScrollMessageBox(QtWidgets.QDialog):
     def __init__(self, items, width, height, *args, **kwargs):
         QtWidgets.QDialog.__init__(self, *args, **kwargs)
@@ -86,9 +116,11 @@ class SearchDialog(QtWidgets.QDialog):
         QtWidgets.QDialog.__init__(self, gui)
         self.plugin = plugin
         self.gui = gui
+        self.change_tracker = ChangeTracker()
         self._cache_locally_current_db_reference()
 
         self.elastic_search_client = None
+        self.backend = None
         self.conversion_time_dict = {}
 
         self.setWindowTitle(TITLE)
@@ -126,6 +158,15 @@ class SearchDialog(QtWidgets.QDialog):
 
         self.layout.addLayout(self.search_text_layout)
 
+        self.preview_label = QtWidgets.QLabel()
+        self.preview_label.setEnabled(False)
+        self.layout.addWidget(self.preview_label)
+
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self.preview_timer.timeout.connect(self.on_preview)
+
         self.search_button = QtWidgets.QToolButton(self)
         self.search_button.setEnabled(False)
         self.search_button.setToolButtonStyle(Qt.ToolButtonStyle.ToolButtonTextBesideIcon)
@@ -217,10 +258,47 @@ class SearchDialog(QtWidgets.QDialog):
         self.delete_workers_submitted = 0
         self.delete_workers_complete = 0
 
+        self.convert_workers_complete = 0
+
+        self.indexer = None
+        self.calibre_text = None
+
         self.pdftotext_full_path = None
+        self.pdf_slots_lock = threading.Lock()
+        self.pdf_slots_reserved = 0
 
         self.ids = None
 
+        self.full_scan = True
+        self.scanned_book_ids = []
+
+        self.busy = False
+        self.background_run = False
+        self.deferred_proc = None
+
+        self.index_changed = False
+        self.rebuild = False
+        self.bulk_load = False
+        self.target_index = None
+        self.state_id = None
+
+        self.search_worker = None
+        self.upgrade_worker = None
+        self.reconcile_worker = None
+        self.rebuild_worker = None
+        self.search_serial = 0
+        self.search_results = set()
+        self.search_cache_key = None
+        self.search_generation = 0
+        self.search_state_id = None
+        self.search_marked_at = None
+
+        self.preview_worker = None
+        self.preview_serial = 0
+        self.preview_pending = False
+
+        self.canceled = threading.Event()
+
         self._upgrade_to_current_version()
 
         self.key_pressed.connect(self.on_key_pressed)
@@ -231,6 +309,9 @@ class SearchDialog(QtWidgets.QDialog):
     def _cache_locally_current_db_reference(self):
         self.full_db = self.gui.current_db
         self.db = self.full_db.new_api
+        self.index_state = get_index_state_store()
+        self.index_state.migrate_from_prefs(prefs, self.db.library_id)
+        self.change_tracker.attach(self.db)
 
     def _upgrade_to_current_version(self):
         old_version = tuple(prefs.get('version', [0, 0, 0]))
@@ -241,14 +322,20 @@ class SearchDialog(QtWidgets.QDialog):
             file_formats = set(prefs['file_formats'].split(',') + ARCHIVE_FORMATS)
             prefs['file_formats'] = ','.join(file_formats)
 
-        if old_version < (2, 1, 0):
+        if old_version < (2, 1, 0) and prefs['search_backend'] == BACKEND_ELASTICSEARCH:
             res = self._get_elasticsearch_client_or_show_error()
             if not res:
                 return
 
-            self.elastic_search_client.indices.put_settings(body={'index.blocks.write': True}, index='library', ignore=[400, 404])
-            self.elastic_search_client.indices.clone('library', self._get_elasticsearch_library_name(), ignore=[400, 404])
-            self.elastic_search_client.indices.delete('library', ignore=[400, 404])
+            try:
+                if self.elastic_search_client.indices.exists(index='library'):
+                    clone_into_library_index(self.elastic_search_client, 'library', self._get_elasticsearch_library_name())
+            except Exception as ex:
+                # The version is left as it is, so the next start tries again
+                print('{}> Could not move index of version {} to the library index: {}'.format(TITLE, old_version, ex))
+                from calibre.gui2 import error_dialog
+                error_dialog(self, TITLE, 'Could not upgrade search index: {}'.format(ex), show=True)
+                return
 
         prefs['version'] = CapsPlugin.version
 
@@ -272,6 +359,30 @@ class SearchDialog(QtWidgets.QDialog):
 
         return self.pdftotext_full_path
 
+    def _get_pdf_page_ranges(self, input, pdftotext_full_path, parts):
+        if parts < 2:
+            return None
+        pdfinfo_full_path = get_pdfinfo_path(pdftotext_full_path)
+        if not pdfinfo_full_path:
+            return None
+        pages = get_page_count(pdfinfo_full_path, input)
+        if not pages or pages <= prefs['pdf_split_pages']:
+            return None
+        return split_pages(pages, parts)
+
+    # Page ranges are only extracted by threads the rest of the run leaves
+    # idle, so splitting never runs more pdftotext processes than the
+    # configured concurrency. Returns the number of extra processes granted
+    def _reserve_pdf_slots(self):
+        with self.pdf_slots_lock:
+            free = max(0, prefs['concurrency'] - self.thread_pool.activeThreadCount() - self.pdf_slots_reserved)
+            self.pdf_slots_reserved += free
+        return free
+
+    def _release_pdf_slots(self, slots):
+        with self.pdf_slots_lock:
+            self.pdf_slots_reserved -= slots
+
     def on_search_all(self):
         self.ids = None
         self.on_search()
@@ -282,16 +393,28 @@ class SearchDialog(QtWidgets.QDialog):
         self.on_search()
 
     def on_search(self):
+        # A newer search supersedes the one in flight
+        self._cancel_search()
+        if self._defer_while_background_run(self.on_search):
+            return
         self._cache_locally_current_db_reference()
         self.status_label.setText('')
         self._manage_lru()
         if prefs['autoindex']:
-            self._reindex(self.do_search)
+            if self.change_tracker.needs_full_scan():
+                self._reindex(self.do_search)
+            else:
+                # Only books Calibre reported as changed since the last scan
+                dirty = self.change_tracker.take_dirty()
+                if dirty:
+                    self._reindex(self.do_search, dirty)
+                else:
+                    self.do_search()
         else:
             self.do_search()
 
     def _get_elasticsearch_library_name(self):
-        return 'calibre-library-{}'.format(self.db.library_id)
+        return get_library_alias(self.db.library_id)
 
     def _manage_lru(self):
         current_text = self.search_textbox.currentText()
@@ -316,7 +439,7 @@ class SearchDialog(QtWidgets.QDialog):
 
     def _get_elasticsearch_client_or_show_error(self):
 
-        self.elastic_search_client, reason = get_elasticsearch_client(self, TITLE, prefs['elasticsearch_url'], prefs['elasticsearch_launch_path'])
+        self.elastic_search_client, reason = get_elasticsearch_client(self, TITLE, prefs['elasticsearch_url'], prefs['elasticsearch_launch_path'], self._get_elasticsearch_library_name())
 
         if not self.elastic_search_client:
             from calibre.gui2 import error_dialog
@@ -328,46 +451,26 @@ class SearchDialog(QtWidgets.QDialog):
             self._set_idle_mode()
             return False
 
-        if not self.elastic_search_client.ping():
-            from calibre.gui2 import error_dialog
-            error_dialog(
-                self,
-                TITLE,
-                'Could not connect to ElasticSearch cluster. Please make sure that it\'s running.',
-                show=True)
-            self._set_idle_mode()
-            return False
-
-        test_req = {
-            '_source': False,
-            'query': {
-                'simple_query_string': {
-                    'query': '',
-                }
-            }
-        }
+        return True
 
-        res = None
-        for i in range(3):
-            try:
-                res = self.elastic_search_client.search(index=self._get_elasticsearch_library_name(), body=json.dumps(test_req), ignore=[404])
-                break
-            except Exception as ex:
-                time.sleep(0.5)
+    def _get_running_elasticsearch_client(self):
+        # Background indexing must neither launch ElasticSearch nor show dialogs
+        self.elastic_search_client = get_running_elasticsearch_client(prefs['elasticsearch_url'])
+        return self.elastic_search_client is not None
 
-        if not res:
-            from calibre.gui2 import error_dialog
-            error_dialog(
-                self,
-                TITLE,
-                'Could not connect to ElasticSearch cluster. Please make sure that it\'s running.',
-                show=True)
-            self._set_idle_mode()
-            return False
+    def _get_backend_or_show_error(self, background=False):
+        if prefs['search_backend'] == BACKEND_SQLITE:
+            self.backend = get_sqlite_backend(self.db.library_id)
+            return True
 
-        return True
+        if background:
+            res = self._get_running_elasticsearch_client()
+        else:
+            res = self._get_elasticsearch_client_or_show_error()
+        self.backend = ElasticsearchBackend(self.elastic_search_client, self.db.library_id) if res else None
+        return res
 
-    def _reindex(self, completion_proc=None):
+    def _reindex(self, completion_proc=None, book_ids=None, background=False, rebuild=False):
         # Start conversion time dictionaries
         self.timer_start = {}
         self.timer_end = {}
@@ -376,63 +479,274 @@ class SearchDialog(QtWidgets.QDialog):
         # Set timer for the whole indexing
         self.timer_total_start = timer()
 
-        self._set_searching_mode()
+        self.busy = True
+        self.background_run = background
+        if not background:
+            self._cancel_search()
+            self._set_searching_mode()
 
         self.canceled = threading.Event()
 
-        res = self._get_elasticsearch_client_or_show_error()
+        res = self._get_backend_or_show_error(background)
         if not res:
+            if book_ids is not None:
+                self.change_tracker.restore(book_ids)
+            self._run_finished(None)
             return
 
-        index_state = prefs.get(self.db.library_id, {}).get('index_state', {})
+        try:
+            index_current = rebuild or self.backend.ensure_index()
+        except Exception as ex:
+            self._fail_run(book_ids, 'Could not open search index', ex)
+            return
 
-        all_formats = set()
-        self.update_list = []
-        self.delete_list = []
+        if not index_current and not background:
+            # Background runs keep writing into the old index until the user
+            # is around. Copying the documents can take long, so it runs off
+            # the GUI thread
+            self.status_label.setText('Upgrading search index...')
+            self.upgrade_worker = TaskWorker(self.backend.upgrade_index)
+            self.upgrade_worker.signals.done.connect(functools.partial(self.on_index_upgraded, completion_proc, book_ids))
+            QtCore.QThreadPool.globalInstance().start(self.upgrade_worker)
+            return
 
-        epoch = datetime.datetime(1, 1, 1, 0, 0, tzinfo=dateutil.tz.tzutc())
+        self._start_indexing(completion_proc, book_ids, background, rebuild)
 
-        file_formats = prefs['file_formats'].split(',')
-        for book_id in self.db.all_book_ids():
-            if 'noindex' not in self.db.get_metadata(book_id).tags:
-                for format in self.db.formats(book_id):
-                    if format in file_formats:
-                        last_modified = self.db.format_metadata(book_id, format)['mtime']
-                        key = concat(book_id, format)
-                        all_formats.add(key)
-                        if index_state.get(key, epoch) < last_modified:
-                            self.update_list.append({
-                                'book_id': book_id,
-                                'format': format,
-                                'metadata': str(self.db.get_metadata(book_id)),
-                                'input': self.db.format_abspath(book_id, format),
-                                'last_modified': last_modified,
-                                'completion_proc': completion_proc
-                            })
-
-        self.delete_list = [k for k in index_state.keys() if k not in all_formats]
+    def on_index_upgraded(self, completion_proc, book_ids, result, error):
+        self.upgrade_worker = None
+        self.status_label.setText('')
+
+        if error:
+            self._fail_run(book_ids, 'Could not upgrade search index', error)
+            return
+
+        self.index_state.bump_generation(self.backend.state_id)
+        if self.canceled.is_set():
+            if book_ids is not None:
+                self.change_tracker.restore(book_ids)
+            self.status_label.setText('Cancelled')
+            self._run_finished(None)
+            return
+
+        self._start_indexing(completion_proc, book_ids, False, False)
+
+    def _fail_run(self, book_ids, message, error):
+        # Ends a run that could not get going; its books are indexed next time
+        print('{}> {}: {}'.format(TITLE, message, error))
+        if not self.background_run:
+            from calibre.gui2 import error_dialog
+            error_dialog(self, TITLE, '{}: {}'.format(message, error), show=True)
+        if book_ids is not None:
+            self.change_tracker.restore(book_ids)
+        self._run_finished(None)
+
+    def _start_indexing(self, completion_proc, book_ids, background, rebuild):
+        try:
+            self._recover_bulk_load()
+        except Exception as ex:
+            self._fail_run(book_ids, 'Could not restore search index settings', ex)
+            return
+
+        self.text_cache = get_text_cache()
+        self.calibre_text = get_calibre_text_source(self.db) if prefs['use_calibre_fts'] else None
+        self.conversion_pool = get_conversion_pool()
+        extractor_registry.reset_timings()
+
+        self.full_scan = book_ids is None
+        self.rebuild = rebuild
+        self.bulk_load = False
+        if rebuild:
+            # Searches keep using the current index until the new one is complete
+            try:
+                self.target_index = self.backend.create_rebuild_target()
+            except Exception as ex:
+                self._fail_run(book_ids, 'Could not create new search index', ex)
+                return
+            self.state_id = REBUILD_STATE_ID.format(self.backend.state_id)
+            self.index_state.clear(self.state_id)
+        else:
+            self.target_index = self.backend.live_target()
+            self.state_id = self.backend.state_id
+        if self.full_scan:
+            self.change_tracker.take_dirty()
+        self.scanned_book_ids = book_ids
+
+        self.update_list, self.delete_list = self._scan(self.db, self.state_id, book_ids)
+
+        self.add_workers_submitted = len(self.update_list)
+        self.add_workers_complete = 0
+        self.delete_workers_submitted = len(self.delete_list)
+        self.delete_workers_complete = 0
+        self.convert_workers_complete = 0
+        self.index_changed = False
 
         if len(self.update_list) + len(self.delete_list) > 0:
             self.thread_pool.setMaxThreadCount(prefs['concurrency'])
-            self.add_workers_submitted = len(self.update_list)
-            self.add_workers_complete = 0
-            self.delete_workers_submitted = len(self.delete_list)
-            self.delete_workers_complete = 0
+            if not background and (rebuild or len(self.update_list) >= BULK_LOAD_MIN_BOOKS):
+                try:
+                    self.backend.begin_bulk_load(self.target_index)
+                except Exception as ex:
+                    # Whatever settings were already changed are restored by the next run
+                    self._fail_run(book_ids, 'Could not prepare search index for indexing', ex)
+                    return
+                self.bulk_load = True
             self.progress_bar.setMaximum(len(self.update_list) + int(len(self.delete_list) / 20))
+
+            self.indexer = self.backend.create_indexer(self.target_index,
+                [(concat(curr['book_id'], curr['format']), curr) for curr in self.delete_list])
+            self.indexer.signals.indexed.connect(functools.partial(self.book_indexed, completion_proc))
+            QtCore.QThreadPool.globalInstance().start(self.indexer)
+
             for curr in self.update_list:
                 worker = AsyncWorker(self.add_book, curr)
                 worker.signals.started.connect(self.add_worker_started)
-                worker.signals.finished.connect(self.add_worker_complete)
-                self.thread_pool.start(worker)
-            for curr in self.delete_list:
-                curr = {'book_id': curr, 'completion_proc': completion_proc}
-                worker = AsyncWorker(self.delete_book, curr)
-                worker.signals.finished.connect(self.delete_worker_complete)
+                worker.signals.finished.connect(functools.partial(self.add_worker_complete, completion_proc))
                 self.thread_pool.start(worker)
+            if not self.update_list:
+                self.indexer.close()
         else:
+            self._check_work_complete(completion_proc)
+
+    def _finish_rebuild(self, completion_proc, discard):
+        # Replacing the live index, or dropping the new one, rewrites every
+        # row of the library in the built-in index, so it runs off the GUI
+        # thread
+        self.rebuild_worker = TaskWorker(self.backend.discard if discard else self.backend.publish, self.target_index)
+        self.rebuild_worker.signals.done.connect(functools.partial(self.on_rebuild_finished, completion_proc, discard))
+        QtCore.QThreadPool.globalInstance().start(self.rebuild_worker)
+
+    def on_rebuild_finished(self, completion_proc, discarded, result, error):
+        self.rebuild_worker = None
+
+        if error:
+            self._report_finish_error(error)
+        elif discarded:
+            self.index_state.clear(self.state_id)
+        else:
+            self.index_state.replace(self.backend.state_id, self.state_id)
+            self.index_state.bump_generation(self.backend.state_id)
+            if prefs['optimize_after_rebuild']:
+                self.backend.optimize()
+
+        # The live index only caught up when the new one went live
+        self._complete_run(completion_proc, reconciled=not (error or discarded))
+
+    def _recover_bulk_load(self):
+        # Bulk load settings left behind by a run that never finished; what it
+        # managed to index only becomes visible now
+        if self.backend.recover():
+            self.index_state.bump_generation(self.backend.state_id)
+
+    def _scan(self, db, state_id, book_ids=None):
+        # Compares the library (or the given books of it) against the index
+        # state and returns the lists of formats to index and to delete
+        if book_ids is None:
+            index_state = self.index_state.load(state_id)
+            book_ids = db.all_book_ids()
+        else:
+            index_state = self.index_state.load(state_id, book_ids)
+            book_ids = [book_id for book_id in book_ids if db.has_id(book_id)]
+
+        all_formats = set()
+        update_list = []
+
+        epoch = datetime.datetime(1, 1, 1, 0, 0, tzinfo=dateutil.tz.tzutc())
+
+        file_formats = set(prefs['file_formats'].split(','))
+
+        # Fetch whole columns at once instead of building a Metadata object per book
+        all_tags = db.all_field_for('tags', book_ids, default_value=())
+        all_book_formats = db.all_field_for('formats', book_ids, default_value=())
+
+        for book_id in book_ids:
+            if 'noindex' in all_tags[book_id]:
+                continue
+            for format in all_book_formats[book_id]:
+                if format not in file_formats:
+                    continue
+                format_metadata = db.format_metadata(book_id, format)
+                if not format_metadata:
+                    continue
+                last_modified = format_metadata['mtime']
+                key = (book_id, format)
+                all_formats.add(key)
+                stored_modified, stored_fingerprint = index_state.get(key, (epoch, None))
+                if stored_modified < last_modified:
+                    update_list.append({
+                        'book_id': book_id,
+                        'format': format,
+                        'input': format_metadata['path'],
+                        'last_modified': last_modified,
+                        'fingerprint': stored_fingerprint,
+                        'op': 'index'
+                    })
+
+        delete_list = [{'book_id': book_id, 'format': format, 'op': 'delete'} for book_id, format in index_state.keys() if (book_id, format) not in all_formats]
+
+        return update_list, delete_list
+
+    def is_busy(self):
+        return self.busy or self.search_worker is not None or self.reconcile_worker is not None
+
+    def change_tracker_for_current_library(self):
+        self._cache_locally_current_db_reference()
+        return self.change_tracker
+
+    def reconcile(self):
+        # Full scan without indexing anything: changed books are queued in the
+        # change tracker for the background scheduler to pick up. Scanning a
+        # large library takes a while, so it runs off the GUI thread
+        if self.reconcile_worker:
+            return
+        self._cache_locally_current_db_reference()
+        token = self.change_tracker.scan_token()
+        self.change_tracker.take_dirty()
+        self.reconcile_worker = TaskWorker(self._scan, self.db, get_state_id(self.db.library_id))
+        self.reconcile_worker.signals.done.connect(functools.partial(self.on_reconciled, token))
+        QtCore.QThreadPool.globalInstance().start(self.reconcile_worker)
+
+    def on_reconciled(self, token, result, error):
+        self.reconcile_worker = None
+        if error:
+            print('{}> Could not scan library: {}'.format(TITLE, error))
+            return
+        # The library was switched or the index cleared in the meantime
+        if token != self.change_tracker.scan_token():
+            return
+        update_list, delete_list = result
+        self.change_tracker.restore(set(curr['book_id'] for curr in update_list + delete_list))
+        self.change_tracker.mark_reconciled()
+
+    def index_in_background(self, book_ids):
+        self._cache_locally_current_db_reference()
+        self._reindex(book_ids=book_ids, background=True)
+
+    def _defer_while_background_run(self, proc):
+        # A user request arriving in the middle of background indexing winds
+        # the background run down first and is executed once it has finished
+        if not (self.busy and self.background_run):
+            return False
+        self.deferred_proc = proc
+        self.canceled.set()
+        self._set_searching_mode()
+        return True
+
+    def _run_finished(self, completion_proc):
+        background = self.background_run
+        self.busy = False
+        self.background_run = False
+
+        if not background or self.deferred_proc:
             self._set_idle_mode()
-            if completion_proc:
-                completion_proc()
+
+        if self.deferred_proc:
+            proc = self.deferred_proc
+            self.deferred_proc = None
+            proc()
+            return
+
+        if completion_proc:
+            completion_proc()
 
     def add_worker_started(self, args):
         id = concat(args['book_id'], args['format'])
@@ -442,7 +756,7 @@ class SearchDialog(QtWidgets.QDialog):
         # Sets the initial timer for conversion
         self.timer_start.update({id: timer()})
 
-    def add_worker_complete(self, args):
+    def add_worker_complete(self, completion_proc, args):
         id = concat(args['book_id'], args['format'])
         for i in range(self.details.count()):
             item = self.details.item(i)
@@ -457,38 +771,97 @@ class SearchDialog(QtWidgets.QDialog):
                 # Add it to a dictionary with all the converted books
                 self.conversion_time_dict.update({id: self.conversion_time_seconds})
                 break
-        if not self.canceled.is_set():
-            self.progress_bar.setValue(self.progress_bar.value() + 1)
-        self.add_workers_complete += 1
-        self._check_work_complete(args['completion_proc'])
-
-    def delete_worker_complete(self, args):
-        if not self.canceled.is_set():
-            if self.delete_workers_complete % 20 == 0:
+        self.convert_workers_complete += 1
+        if self.convert_workers_complete == self.add_workers_submitted:
+            self.indexer.close()
+            self._check_work_complete(completion_proc)
+
+    def book_indexed(self, completion_proc, args):
+        if args['ok'] and not args.get('unchanged'):
+            self.index_changed = True
+        if args['op'] == 'delete':
+            if args['ok']:
+                self.index_state.delete(self.state_id, args['book_id'], args['format'])
+            if not self.canceled.is_set():
+                if self.delete_workers_complete % 20 == 0:
+                    self.progress_bar.setValue(self.progress_bar.value() + 1)
+            self.delete_workers_complete += 1
+        else:
+            if args['ok']:
+                self.index_state.set(self.state_id, args['book_id'], args['format'], args['last_modified'], args['fingerprint'])
+            if not self.canceled.is_set():
                 self.progress_bar.setValue(self.progress_bar.value() + 1)
-        self.delete_workers_complete += 1
-        self._check_work_complete(args['completion_proc'])
+            self.add_workers_complete += 1
+        self._check_work_complete(completion_proc)
 
     def _check_work_complete(self, completion_proc):
         if self.add_workers_complete != self.add_workers_submitted or self.delete_workers_complete != self.delete_workers_submitted:
             return
+        # Skipped books are reported by the indexer before their worker has
+        # finished; a worker still running would be counted against the next run
+        if self.convert_workers_complete != self.add_workers_submitted:
+            return
+
+        self.index_state.commit()
+
+        failed = False
+        try:
+            if self.bulk_load:
+                # Left on record when it fails, the next run restores the settings
+                self.bulk_load = False
+                self.backend.end_bulk_load(self.target_index)
+            elif self.index_changed:
+                # Make the changes visible before any search can be cached under
+                # the new generation
+                self.backend.refresh(self.target_index)
+        except Exception as ex:
+            self._report_finish_error(ex)
+            failed = True
+
+        if self.rebuild:
+            # A new index that may never have been refreshed does not go live
+            self._finish_rebuild(completion_proc, failed or self.canceled.is_set())
+            return
+
+        if self.index_changed:
+            self.index_state.bump_generation(self.backend.state_id)
+        self._complete_run(completion_proc)
+
+    def _report_finish_error(self, error):
+        print('{}> Could not finish indexing: {}'.format(TITLE, error))
+        if not self.background_run:
+            from calibre.gui2 import error_dialog
+            error_dialog(self, TITLE, 'Could not finish indexing: {}'.format(error), show=True)
+
+    def _complete_run(self, completion_proc, reconciled=True):
+        if self.index_changed:
+            self.backend.record_size()
+
+        if self.delete_workers_submitted:
+            self.text_cache.prune()
+
+        extractor_registry.print_timings()
 
         if self.canceled.is_set():
-            self.status_label.setText('Cancelled')
+            if not self.background_run:
+                self.status_label.setText('Cancelled')
             self.progress_bar.setValue(0)
+            if not self.full_scan:
+                self.change_tracker.restore(self.scanned_book_ids)
         else:
             self.progress_bar.setValue(self.progress_bar.maximum())
+            if self.full_scan and reconciled:
+                self.change_tracker.mark_reconciled()
 
         self.workers_submitted = 0
         self.workers_complete = 0
 
-        self._set_idle_mode()
-        if completion_proc:
-            completion_proc()
+        self._run_finished(completion_proc)
 
     def convert_book(self, input, format):
         if format in ARCHIVE_FORMATS:
             content = []
+            directory = None
             try:
                 file_formats = prefs['file_formats'].split(',')
                 directory = calibre.ptempfile.PersistentTemporaryDirectory()
@@ -500,103 +873,195 @@ class SearchDialog(QtWidgets.QDialog):
                                 content += self.convert_book(os.path.join(curr_dir, f), fmt)
             except Exception as ex:
                 print('{}> {}'.format(TITLE, ex))
+            finally:
+                if directory:
+                    shutil.rmtree(directory, ignore_errors=True)
 
             return content
 
-        output = self.plugin.temporary_file(suffix='.txt').name
-        done = False
+        content = extractor_registry.extract(input, format)
+        if content is not None:
+            return content
+
         if format == 'PDF':
             pdftotext_full_path = self._get_pdftotext_full_path()
             if pdftotext_full_path:
-                subprocess_call([pdftotext_full_path, '-enc', 'UTF-8', input, output])
-                # print('Book {} converted with pdfttotext.'.format(id))
-                done = True
+                with extractor_registry.timer('pdftotext'):
+                    slots = self._reserve_pdf_slots()
+                    try:
+                        ranges = self._get_pdf_page_ranges(input, pdftotext_full_path, slots + 1)
+                        if ranges:
+                            return pdftotext_page_ranges(pdftotext_full_path, input, ranges)
+                        return pdftotext(pdftotext_full_path, input)
+                    finally:
+                        self._release_pdf_slots(slots)
+
+        # Calibre conversion can only write to a file, so use a temporary one
+        # and remove it as soon as it has been read
+        output = self.plugin.temporary_file(suffix='.txt').name
+        try:
+            return self._convert_to_file(input, output)
+        finally:
+            try:
+                os.remove(output)
+            except OSError:
+                pass
+
+    def _convert_to_file(self, input, output):
+        done = False
+        try:
+            with extractor_registry.timer('conversion pool'):
+                done = self.conversion_pool.convert(input, output)
+        except Exception as ex:
+            print('{}> {}'.format(TITLE, ex))
         if not done:
+            # Whatever a failed or crashed worker left behind is not the text
+            try:
+                os.remove(output)
+            except OSError:
+                pass
             os_name = platform.system()
             ebook_convert_path = '/Applications/calibre.app/Contents/MacOS/ebook-convert' if os_name == 'Darwin' else 'ebook-convert'
-            subprocess_call([ebook_convert_path, input, output])
+            with extractor_registry.timer('ebook-convert'):
+                if subprocess_call([ebook_convert_path, input, output]) != 0:
+                    # Raising keeps the book out of the index state, so it is retried
+                    raise RuntimeError('Could not convert {}'.format(input))
         # print('Book {} converted to plaintext'.format(id))
 
-        if sys.version_info[0] >= 3:
-            content = open(output, errors='ignore').readlines()
-        else:
-            content = open(output).readlines()
-        return content
+        return read_lines(output)
+
+    def _get_calibre_text(self, args):
+        if not self.calibre_text:
+            return None
+        with extractor_registry.timer('calibre fts'):
+            return self.calibre_text.get(args['book_id'], args['format'], args['input'])
 
     def add_book(self, args):
 
         try:
             if self.canceled.is_set():
+                self.indexer.skip(args)
                 return
             id = concat(args['book_id'], args['format'])
-            print('{}> Book {} start processing: {}'.format(TITLE, id, args['input']))
-            content = self.convert_book(args['input'], args['format'])
+
+            # Only the mtime was bumped: refresh the stored timestamp, no conversion needed
+            current_fingerprint, digest = fingerprint(args['input'])
+            if current_fingerprint == args['fingerprint']:
+                print('{}> Book {} unchanged: {}'.format(TITLE, id, args['input']))
+                self.indexer.skip(dict(args, unchanged=True), ok=True)
+                return
+            args['fingerprint'] = current_fingerprint
+
+            content, cache_key = self.text_cache.lookup(args['input'], digest)
+            if content is not None:
+                print('{}> Book {} loaded from text cache: {}'.format(TITLE, id, args['input']))
+            else:
+                # Calibre keeps this text itself, no need to cache a copy
+                content = self._get_calibre_text(args)
+                if content is not None:
+                    print('{}> Book {} loaded from Calibre full text index: {}'.format(TITLE, id, args['input']))
+                else:
+                    print('{}> Book {} start processing: {}'.format(TITLE, id, args['input']))
+                    content = self.convert_book(args['input'], args['format'])
+                    if content:
+                        self.text_cache.store(cache_key, content)
 
             doc = {
-                'metadata': args['metadata'],
+                'book_id': args['book_id'],
+                'format': args['format'],
+                'metadata': str(self.db.get_metadata(args['book_id'])),
                 'content': content
             }
-            res = self.elastic_search_client.index(index=self._get_elasticsearch_library_name(), id=id, body=doc)
-            print('{}> Book {} "{}" in index'.format(TITLE, id, res['result']))
-
-            if 'index_state' not in prefs.setdefault(self.db.library_id, {}):
-                prefs[self.db.library_id]['index_state'] = {}
-            prefs[self.db.library_id]['index_state'][id] = args['last_modified']
-            prefs.commit()
-
-        except Exception as ex:
-            print('{}> {}'.format(TITLE, ex))
-
-    def delete_book(self, args):
-        try:
-            self.elastic_search_client.delete(index=self._get_elasticsearch_library_name(), id=args['book_id'], ignore=[404])
-            # print('Deleted {}'.format(id['book_id']))
-
-            if 'index_state' in prefs.get(self.db.library_id, {}):
-                del prefs[self.db.library_id]['index_state'][args['book_id']]
-                prefs.commit()
+            self.indexer.put(id, doc, args)
 
         except Exception as ex:
             print('{}> {}'.format(TITLE, ex))
+            self.indexer.skip(args)
 
     def do_search(self):
 
-        req = {
-            '_source': False,
-            'query': {
-                'simple_query_string': {
-                    'query': self.search_textbox.currentText(),
-                    'default_operator': 'AND'
-                }
-            }
-        }
+        text = self.search_textbox.currentText()
 
-        res = self._get_elasticsearch_client_or_show_error()
-        if not res:
+        if has_unfinished_bulk_load(self.db.library_id):
+            res = self._get_backend_or_show_error()
+            if not res:
+                return
+            self._recover_bulk_load()
+
+        result_cache = get_result_cache()
+        state_id = get_state_id(self.db.library_id)
+        generation = self.index_state.generation(state_id)
+        cache_key = result_cache.key(state_id, generation, text, self.ids)
+        matched_ids = result_cache.get(cache_key)
+        if matched_ids is not None:
+            print('{}> Search results loaded from result cache'.format(TITLE))
+            self._show_search_results(matched_ids)
             return
 
-        res = self.elastic_search_client.search(index=self._get_elasticsearch_library_name(), body=json.dumps(req), scroll="1m", ignore=[404])
-
-        hits_number = res.get('hits', {}).get('total', {}).get('value', 0)
-        page_size = len(res.get('hits', {}).get('hits', []))
-        scroll_id = res['_scroll_id']
-
-        matched_ids = set()
+        res = self._get_backend_or_show_error()
+        if not res:
+            return
 
-        for _ in range(hits_number):
-            if not res['hits']['hits']:
-                res = self.elastic_search_client.scroll(scroll="1m", scroll_id=scroll_id, ignore=[404])
+        self._cancel_search()
+        self.search_results = set()
+        self.search_cache_key = cache_key
+        self.search_generation = generation
+        self.search_state_id = state_id
+        self.search_marked_at = None
+
+        self.search_worker = SearchWorker(self.search_serial, self.backend, text, self.ids, prefs['search_page_size'])
+        self.search_worker.signals.page.connect(self.on_search_page)
+        self.search_worker.signals.finished.connect(self.on_search_finished)
+        self._set_query_mode()
+        self.status_label.setText('Searching...')
+        QtCore.QThreadPool.globalInstance().start(self.search_worker)
+
+    def _cancel_search(self):
+        if self.search_worker:
+            self.search_worker.cancel()
+            self.search_worker = None
+        # Whatever the old worker still reports is ignored from now on
+        self.search_serial += 1
+
+    def on_search_page(self, serial, book_ids, book_count):
+        if serial != self.search_serial:
+            return
+        self.search_results.update(book_ids)
+
+        now = timer()
+        if self.search_marked_at is None or now - self.search_marked_at >= SEARCH_PROGRESS_INTERVAL:
+            self.search_marked_at = now
+            if book_count:
+                self.status_label.setText('Found {} of about {} books...'.format(len(self.search_results), max(book_count, len(self.search_results))))
+            else:
+                self.status_label.setText('Found {} books...'.format(len(self.search_results)))
+            self._mark_search_results(self.search_results)
+
+    def on_search_finished(self, serial, canceled, error):
+        if serial != self.search_serial:
+            return
+        self.search_worker = None
+        self._set_idle_mode()
 
-            curr = res['hits']['hits'].pop(0)
-            id = int(curr['_id'].split(':')[0])
-            if self.ids is None or id in self.ids:
-                matched_ids.add(id)
+        if error:
+            from calibre.gui2 import error_dialog
+            self.status_label.setText('')
+            error_dialog(self, TITLE, 'Search failed: {}'.format(error), show=True)
+        elif canceled:
+            self.status_label.setText('Cancelled')
+        else:
+            get_result_cache().put(self.search_cache_key, self.search_state_id, self.search_generation, self.search_results)
+            self._show_search_results(self.search_results)
 
-        self.status_label.setText('Found {} books'.format(len(matched_ids)))
+    def _mark_search_results(self, matched_ids):
         self.full_db.set_marked_ids(dict.fromkeys(matched_ids, 'search_results'))
         self.gui.search.setEditText('marked:search_results')
         self.gui.search.do_search()
 
+    def _show_search_results(self, matched_ids):
+        self.status_label.setText('Found {} books'.format(len(matched_ids)))
+        self._mark_search_results(matched_ids)
+
         # If new books are found, it shows which file took the longest and also the total time of conversion/indexing
         if self.conversion_time_dict:
             self.max_conversion_time_seconds = self.conversion_time_dict[
@@ -620,10 +1085,22 @@ class SearchDialog(QtWidgets.QDialog):
         self.cancel_button.setVisible(False)
         self.cancel_button.setText('&Cancel')
         self.progress_bar.setVisible(False)
+        if self.progress_bar.maximum() == 0:
+            # Leave the busy indicator shown while searching
+            self.progress_bar.setRange(0, 1)
         self.details_button.setVisible(False)
         self.details.setVisible(False)
         self.search_textbox.setFocus(Qt.FocusReason.OtherFocusReason)
 
+    # While a search runs, the dialog stays usable: a new search replaces it
+    # and Cancel stops it
+    def _set_query_mode(self):
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.setText('&Cancel')
+        self.cancel_button.setVisible(True)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setVisible(True)
+
     def _set_searching_mode(self):
         self.search_textbox.setEnabled(False)
         self.search_help_button.setEnabled(False)
@@ -644,7 +1121,14 @@ class SearchDialog(QtWidgets.QDialog):
         self.details_button.setIcon(icon)
 
     def on_cancel(self):
+        if self.search_worker:
+            self._cancel_search()
+            self._set_idle_mode()
+            self.status_label.setText('Cancelled')
+            return
+
         self.status_label.setText('')
+        self.deferred_proc = None
         self.canceled.set()
         self.cancel_button.setText('Cancelling...')
         self.cancel_button.setEnabled(False)
@@ -652,8 +1136,53 @@ class SearchDialog(QtWidgets.QDialog):
     def on_search_text_changed(self, text):
         self.search_button.setEnabled(text != '')
 
+        # Counts still on their way are for an older text
+        self.preview_serial += 1
+        self.preview_label.setText('')
+        if text.strip() and prefs['live_count_preview']:
+            self.preview_timer.start()
+        else:
+            self.preview_timer.stop()
+
+    def _get_preview_backend(self):
+        # Only ever uses a connection made by an earlier search, typing must
+        # not launch ElasticSearch or pop up errors
+        if prefs['search_backend'] == BACKEND_SQLITE:
+            return get_sqlite_backend(self.db.library_id)
+        if self.elastic_search_client:
+            return ElasticsearchBackend(self.elastic_search_client, self.db.library_id)
+        return None
+
+    def on_preview(self):
+        if self.busy or self.search_worker:
+            return
+        backend = self._get_preview_backend()
+        if not backend:
+            return
+        text = self.search_textbox.currentText()
+        if not text.strip():
+            return
+
+        # One request at a time; the latest text is counted once it returns
+        if self.preview_worker:
+            self.preview_pending = True
+            return
+
+        self.preview_worker = CountWorker(self.preview_serial, backend, text)
+        self.preview_worker.signals.counted.connect(self.on_preview_counted)
+        QtCore.QThreadPool.globalInstance().start(self.preview_worker)
+
+    def on_preview_counted(self, serial, count):
+        self.preview_worker = None
+        if serial == self.preview_serial and count is not None:
+            self.preview_label.setText('\u2248{} books'.format(count))
+        if self.preview_pending:
+            self.preview_pending = False
+            self.on_preview()
+
     def reject(self):
         if self.close_button.isEnabled():
+            self._cancel_search()
             self.status_label.setText('')
             QtWidgets.QDialog.reject(self)
 
@@ -672,6 +1201,8 @@ class SearchDialog(QtWidgets.QDialog):
         msgbox.exec_()
 
     def on_reindex(self):
+        if self._defer_while_background_run(self.on_reindex):
+            return
         self._cache_locally_current_db_reference()
         self.status_label.setText('')
         self._reindex()
@@ -683,20 +1214,14 @@ class SearchDialog(QtWidgets.QDialog):
 
         if question_dialog(self, TITLE, 'You are about to rebuild all fulltext search index. This process might take a while. Are you sure?', default_yes=False):
 
-            res = self._get_elasticsearch_client_or_show_error()
-            if not res:
+            if self._defer_while_background_run(self._reindex_all):
                 return
+            self._reindex_all()
 
-            self.status_label.setText('')
-
-            self.elastic_search_client.indices.delete(index=self._get_elasticsearch_library_name(), ignore=[400, 404])
-
-            if self.db.library_id in prefs:
-                prefs[self.db.library_id] = {'index_state': {}}
-
-            prefs.commit()
-
-            self._reindex()
+    def _reindex_all(self):
+        self._cache_locally_current_db_reference()
+        self.status_label.setText('')
+        self._reindex(rebuild=True)
 
     def on_config(self):
         self._cache_locally_current_db_reference()
@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+
+import psutil
+
+TITLE = 'Power Search'
+
+LOCK_FILE_NAME = 'caps-elasticsearch.lock'
+
+# How often the watchdog looks at the node, and how often activity is
+# written to the lock file
+WATCHDOG_INTERVAL = 60.0
+TOUCH_INTERVAL = 60.0
+
+STOP_TIMEOUT = 30.0
+
+# JVM heap for the launched node: half the size of the library indices plus
+# some headroom, within these bounds and never more than a quarter of the RAM
+MIN_HEAP_MB = 512
+MAX_HEAP_MB = 8 * 1024
+HEAP_HEADROOM_MB = 256
+HEAP_STEP_MB = 256
+
+WATCHDOG_COMMAND = 'from calibre.customize.ui import find_plugin; from calibre_plugins.caps.node_lifecycle import watchdog_main; watchdog_main({!r})'
+
+lock = threading.Lock()
+owned_pid = None
+touched_at = 0.0
+
+
+def get_lock_file_path():
+    from calibre_plugins.caps.config import prefs
+    return os.path.join(os.path.dirname(prefs.file_path), LOCK_FILE_NAME)
+
+def read_lock_file(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_lock_file(path, data):
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def remove_lock_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _process(pid, create_time):
+    # The recorded process, unless it is gone and its PID has been reused
+    if not pid:
+        return None
+    try:
+        process = psutil.Process(pid)
+        if create_time is not None and abs(process.create_time() - create_time) > 1.0:
+            return None
+        return process if process.is_running() else None
+    except psutil.Error:
+        return None
+
+def get_java_opts(index_bytes):
+    heap = max(MIN_HEAP_MB, int(index_bytes / (2 * 1024 * 1024)) + HEAP_HEADROOM_MB)
+    heap = min(heap, MAX_HEAP_MB, int(psutil.virtual_memory().total / (4 * 1024 * 1024)))
+    heap = max(MIN_HEAP_MB, heap - heap % HEAP_STEP_MB)
+    return '-Xms{0}m -Xmx{0}m'.format(heap)
+
+def get_launch_env():
+    # A heap configured by the user always wins
+    from calibre_plugins.caps.config import prefs
+
+    env = dict(os.environ)
+    if 'ES_JAVA_OPTS' not in env:
+        env['ES_JAVA_OPTS'] = get_java_opts(sum(prefs['elasticsearch_library_index_bytes'].values()))
+        print('{}> Launch ElasticSearch with ES_JAVA_OPTS={}'.format(TITLE, env['ES_JAVA_OPTS']))
+    return env
+
+def record_index_size(client, alias):
+    # Per library, the node serves every library searched with it
+    from calibre_plugins.caps.config import prefs
+
+    try:
+        res = client.indices.stats(index=alias, metric='store', filter_path='_all.total.store.size_in_bytes')
+        sizes = dict(prefs['elasticsearch_library_index_bytes'])
+        sizes[alias] = res['_all']['total']['store']['size_in_bytes']
+        prefs['elasticsearch_library_index_bytes'] = sizes
+    except Exception as ex:
+        print('{}> Could not get index size: {}'.format(TITLE, ex))
+
+
+def record_launch(pid, url, launch_path):
+    global owned_pid
+
+    from calibre_plugins.caps.config import prefs
+
+    try:
+        create_time = psutil.Process(pid).create_time()
+    except psutil.Error:
+        create_time = None
+    owned_pid = pid
+    path = get_lock_file_path()
+    write_lock_file(path, {
+        'pid': pid,
+        'create_time': create_time,
+        'url': url,
+        'launch_path': launch_path,
+        'idle_shutdown': prefs['elasticsearch_idle_minutes'] * 60,
+        'last_used': time.time(),
+        'watchdog_pid': None,
+        'watchdog_create_time': None
+    })
+    ensure_watchdog()
+
+def attach(url):
+    # Returns the node process left running by an earlier Calibre session
+    # for this URL, or None
+    global owned_pid
+
+    path = get_lock_file_path()
+    data = read_lock_file(path)
+    if not data or data.get('url') != url:
+        return None
+    process = _process(data.get('pid'), data.get('create_time'))
+    if process is None:
+        remove_lock_file(path)
+        return None
+
+    print('{}> Attach to ElasticSearch process {}'.format(TITLE, process.pid))
+    owned_pid = process.pid
+    touch(force=True)
+    ensure_watchdog()
+    return process
+
+def node_gone():
+    # True once the node launched or attached to in this session has stopped,
+    # e.g. after an idle shutdown
+    return owned_pid is not None and not psutil.pid_exists(owned_pid)
+
+def forget():
+    global owned_pid
+
+    owned_pid = None
+    remove_lock_file(get_lock_file_path())
+
+def touch(force=False):
+    # Records that the node is in use, at most once per TOUCH_INTERVAL
+    global touched_at
+
+    if owned_pid is None:
+        return
+    now = time.time()
+    if not force and now - touched_at < TOUCH_INTERVAL:
+        return
+    with lock:
+        touched_at = now
+        path = get_lock_file_path()
+        data = read_lock_file(path)
+        if data:
+            data['last_used'] = now
+            try:
+                write_lock_file(path, data)
+            except (IOError, OSError):
+                pass
+
+def ensure_watchdog():
+    from calibre_plugins.caps.config import prefs
+
+    path = get_lock_file_path()
+    with lock:
+        data = read_lock_file(path)
+        if not data:
+            return
+        data['idle_shutdown'] = prefs['elasticsearch_idle_minutes'] * 60
+        if data['idle_shutdown'] > 0 and _process(data.get('watchdog_pid'), data.get('watchdog_create_time')) is None:
+            try:
+                from calibre.utils.ipc.simple_worker import start_pipe_worker
+                # Detached like the node, so it outlives Calibre's process group
+                # on POSIX; on Windows pipe workers have no console to share
+                watchdog = start_pipe_worker(WATCHDOG_COMMAND.format(path), **({} if os.name == 'nt' else {'start_new_session': True}))
+                data['watchdog_pid'] = watchdog.pid
+                data['watchdog_create_time'] = psutil.Process(watchdog.pid).create_time()
+            except Exception as ex:
+                print('{}> Could not start ElasticSearch watchdog: {}'.format(TITLE, ex))
+        write_lock_file(path, data)
+
+def stop_node(data):
+    if os.name == 'nt' and data.get('launch_path'):
+        service_control_script = os.path.join(data['launch_path'], 'bin', 'elasticsearch-service.bat')
+        if os.path.isfile(service_control_script):
+            from calibre_plugins.caps.subprocess_helper import subprocess_call
+            subprocess_call([service_control_script, 'stop'])
+            return
+
+    process = _process(data.get('pid'), data.get('create_time'))
+    if process is None:
+        return
+    try:
+        processes = process.children(recursive=True) + [process]
+    except psutil.Error:
+        processes = [process]
+    for curr in processes:
+        try:
+            curr.terminate()
+        except psutil.Error:
+            pass
+    _, alive = psutil.wait_procs(processes, timeout=STOP_TIMEOUT)
+    for curr in alive:
+        try:
+            curr.kill()
+        except psutil.Error:
+            pass
+
+
+def watchdog_main(path):
+    # Runs detached from Calibre and stops the node once nobody has used it
+    # for the configured idle period, whether Calibre is running or not
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        data = read_lock_file(path)
+        if not data or data.get('watchdog_pid') != os.getpid():
+            return
+        if _process(data.get('pid'), data.get('create_time')) is None:
+            remove_lock_file(path)
+            return
+        idle_shutdown = data.get('idle_shutdown') or 0
+        if idle_shutdown > 0 and time.time() - data.get('last_used', 0) > idle_shutdown:
+            stop_node(data)
+            remove_lock_file(path)
+            return
@@ -0,0 +1,59 @@
+import math
+import os
+import re
+import threading
+
+from calibre_plugins.caps.subprocess_helper import subprocess_check_output, subprocess_read_lines
+
+PAGES_RE = re.compile(br'^Pages:\s+(\d+)', re.MULTILINE)
+
+def get_pdfinfo_path(pdftotext_path):
+    directory, name = os.path.split(pdftotext_path)
+    pdfinfo_path = os.path.join(directory, name.replace('pdftotext', 'pdfinfo'))
+    return pdfinfo_path if pdfinfo_path != pdftotext_path and os.path.isfile(pdfinfo_path) else None
+
+def get_page_count(pdfinfo_path, input):
+    try:
+        match = PAGES_RE.search(subprocess_check_output([pdfinfo_path, input]))
+    except Exception:
+        return None
+    return int(match.group(1)) if match else None
+
+def split_pages(pages, parts):
+    size = int(math.ceil(float(pages) / parts))
+    return [(first, min(first + size - 1, pages)) for first in range(1, pages + 1, size)]
+
+def pdftotext(pdftotext_path, input, first=None, last=None):
+    cmdline = [pdftotext_path, '-enc', 'UTF-8']
+    if first is not None:
+        cmdline += ['-f', str(first), '-l', str(last)]
+    # '-' makes pdftotext write the text to stdout
+    return subprocess_read_lines(cmdline + [input, '-'])
+
+def pdftotext_page_ranges(pdftotext_path, input, ranges):
+    parts = [[] for _ in ranges]
+    errors = [None for _ in ranges]
+
+    def extract(i, first, last):
+        try:
+            parts[i] = pdftotext(pdftotext_path, input, first, last)
+        except Exception as ex:
+            errors[i] = ex
+
+    threads = []
+    for i, (first, last) in enumerate(ranges):
+        thread = threading.Thread(target=extract, args=(i, first, last))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    # Text with a range of pages missing must not be indexed as the book
+    for error in errors:
+        if error is not None:
+            raise error
+
+    content = []
+    for part in parts:
+        content += part
+    return content
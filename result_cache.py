@@ -0,0 +1,144 @@
+import array
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+TITLE = 'Power Search'
+
+RESULT_CACHE_FILE_NAME = 'caps-result-cache.sqlite'
+
+# Memory held by cached result sets before the least recently used go
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Result sets kept on disk, across all libraries and generations
+MAX_DISK_ENTRIES = 500
+
+
+def normalize_query(query):
+    return ' '.join(query.split())
+
+def _scope_digest(book_ids):
+    if book_ids is None:
+        return 'all'
+    return hashlib.sha1(','.join(str(book_id) for book_id in sorted(set(book_ids))).encode('ascii')).hexdigest()
+
+def _footprint(book_ids):
+    # The set itself plus one int object per member
+    return sys.getsizeof(book_ids) + len(book_ids) * sys.getsizeof(1 << 20)
+
+
+class ResultCache(object):
+
+    def __init__(self, path, on_disk):
+        self.path = path
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.conn = None
+        self.set_on_disk(on_disk)
+
+    def set_on_disk(self, on_disk):
+        with self.lock:
+            if on_disk and self.conn is None:
+                self.conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+                self.conn.execute(
+                    'CREATE TABLE IF NOT EXISTS result_cache ('
+                    ' key TEXT PRIMARY KEY,'
+                    ' library_id TEXT NOT NULL,'
+                    ' generation INTEGER NOT NULL,'
+                    ' last_used REAL NOT NULL,'
+                    ' data BLOB NOT NULL'
+                    ')')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS result_cache_last_used ON result_cache (last_used)')
+                self.conn.commit()
+            elif not on_disk and self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def key(self, library_id, generation, query, book_ids=None):
+        return hashlib.sha1(json.dumps(
+            [library_id, generation, normalize_query(query), _scope_digest(book_ids)]).encode('utf-8')).hexdigest()
+
+    # Returns the frozenset of matched book ids, or None on a miss
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            if self.conn is None:
+                return None
+            row = self.conn.execute('SELECT data FROM result_cache WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            self.conn.execute('UPDATE result_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+
+        book_ids = array.array('q')
+        book_ids.frombytes(zlib.decompress(row[0]))
+        book_ids = frozenset(book_ids)
+        self._remember(key, book_ids)
+        return book_ids
+
+    def put(self, key, library_id, generation, book_ids):
+        book_ids = frozenset(book_ids)
+        self._remember(key, book_ids)
+
+        with self.lock:
+            if self.conn is None:
+                return
+            # Results of older generations can never be hit again
+            self.conn.execute(
+                'DELETE FROM result_cache WHERE library_id = ? AND generation < ?', (library_id, generation))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO result_cache (key, library_id, generation, last_used, data) VALUES (?, ?, ?, ?, ?)',
+                (key, library_id, generation, time.time(), sqlite3.Binary(zlib.compress(array.array('q', sorted(book_ids)).tobytes()))))
+            self.conn.execute(
+                'DELETE FROM result_cache WHERE key NOT IN (SELECT key FROM result_cache ORDER BY last_used DESC LIMIT ?)',
+                (MAX_DISK_ENTRIES,))
+            self.conn.commit()
+
+    def _remember(self, key, book_ids):
+        size = _footprint(book_ids)
+        if size > MAX_MEMORY_BYTES:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.memory_bytes -= _footprint(self.entries.pop(key))
+            self.entries[key] = book_ids
+            self.memory_bytes += size
+            while self.memory_bytes > MAX_MEMORY_BYTES:
+                _, evicted = self.entries.popitem(last=False)
+                self.memory_bytes -= _footprint(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory_bytes = 0
+            if self.conn is not None:
+                self.conn.execute('DELETE FROM result_cache')
+                self.conn.commit()
+
+
+_cache = None
+
+def get_result_cache():
+    global _cache
+
+    from calibre_plugins.caps.config import prefs
+
+    if _cache is None:
+        _cache = ResultCache(os.path.join(os.path.dirname(prefs.file_path), RESULT_CACHE_FILE_NAME), prefs['result_cache_on_disk'])
+    else:
+        _cache.set_on_disk(prefs['result_cache_on_disk'])
+
+    return _cache
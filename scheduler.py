@@ -0,0 +1,133 @@
+import functools
+import heapq
+
+import psutil
+from calibre_plugins.caps.async_worker import TaskWorker
+from calibre_plugins.caps.elasticsearch_helper import get_running_elasticsearch_client
+from calibre_plugins.caps.search_backend import BACKEND_ELASTICSEARCH
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+TITLE = 'Power Search'
+
+TICK_INTERVAL_MS = 15 * 1000
+
+# Books per background run; small enough for a search to preempt it quickly
+BATCH_SIZE_PER_PROCESS = 4
+
+# System-wide CPU usage above which the machine is considered busy
+CPU_BUSY_PERCENT = 50.0
+
+
+class IndexScheduler(QtCore.QObject):
+
+    def __init__(self, plugin):
+        QtCore.QObject.__init__(self)
+        self.plugin = plugin
+        self.cursor_pos = None
+        self.health_worker = None
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(TICK_INTERVAL_MS)
+        self.timer.timeout.connect(self.on_tick)
+
+    def start(self):
+        if not self.timer.isActive():
+            # Start measuring CPU load from now on
+            psutil.cpu_percent(interval=None)
+            self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def _gui_busy(self):
+        if QtWidgets.QApplication.activeModalWidget() or QtWidgets.QApplication.activePopupWidget():
+            return True
+
+        cursor_pos = QtGui.QCursor.pos()
+        moved = self.cursor_pos is not None and cursor_pos != self.cursor_pos
+        self.cursor_pos = cursor_pos
+        if moved:
+            return True
+
+        job_manager = getattr(self.plugin.gui, 'job_manager', None)
+        has_jobs = getattr(job_manager, 'has_jobs', None)
+        return bool(has_jobs and has_jobs())
+
+    def _machine_busy(self):
+        try:
+            battery = psutil.sensors_battery()
+            if battery is not None and not battery.power_plugged:
+                return True
+        except Exception:
+            pass
+
+        return psutil.cpu_percent(interval=None) > CPU_BUSY_PERCENT
+
+    def _next_batch(self, dialog, size):
+        dirty = dialog.change_tracker.take_dirty()
+        if not dirty:
+            return None
+
+        # Removed books only need a cheap delete, so they go first, followed
+        # by the most recently added books
+        db = dialog.db
+        removed = [book_id for book_id in dirty if not db.has_id(book_id)]
+        existing = [book_id for book_id in dirty if db.has_id(book_id)]
+        timestamps = db.all_field_for('timestamp', existing)
+        batch = removed[:size]
+        batch += heapq.nlargest(size - len(batch), existing, key=lambda book_id: (timestamps[book_id], book_id))
+
+        dialog.change_tracker.restore(dirty.difference(batch))
+        return batch
+
+    def on_tick(self):
+        from calibre_plugins.caps.config import prefs
+
+        if not prefs['background_indexing'] or self.health_worker:
+            return
+
+        dialog = self.plugin.search_dialog
+        if dialog and dialog.is_busy():
+            # Our own conversions must not count as load on the next tick
+            psutil.cpu_percent(interval=None)
+            return
+
+        if self._gui_busy() or self._machine_busy():
+            return
+
+        dialog = self.plugin.get_search_dialog()
+        tracker = dialog.change_tracker_for_current_library()
+
+        # Without change notifications there is no queue to work from
+        if not tracker.supported:
+            return
+
+        if tracker.needs_full_scan():
+            dialog.reconcile()
+            return
+
+        batch = self._next_batch(dialog, prefs['concurrency'] * BATCH_SIZE_PER_PROCESS)
+        if not batch:
+            return
+
+        if prefs['search_backend'] == BACKEND_ELASTICSEARCH:
+            # A node that does not answer is only given up on after a timeout,
+            # so it is checked off the GUI thread
+            self.health_worker = TaskWorker(get_running_elasticsearch_client, prefs['elasticsearch_url'])
+            self.health_worker.signals.done.connect(functools.partial(self.on_health_checked, dialog, dialog.db.library_id, batch))
+            QtCore.QThreadPool.globalInstance().start(self.health_worker)
+            return
+
+        self._index(dialog, batch)
+
+    def on_health_checked(self, dialog, library_id, batch, client, error):
+        self.health_worker = None
+        if dialog.db.library_id != library_id:
+            return
+        if client is None or dialog.is_busy():
+            dialog.change_tracker.restore(batch)
+            return
+        self._index(dialog, batch)
+
+    def _index(self, dialog, batch):
+        print('{}> Background indexing of {} books'.format(TITLE, len(batch)))
+        dialog.index_in_background(batch)
@@ -0,0 +1,219 @@
+import threading
+
+from calibre_plugins.caps.fts_store import get_fts_store
+from calibre_plugins.caps.index_helper import begin_bulk_load, create_next_index, delete_library_index, end_bulk_load, ensure_index, optimize_index, switch_alias, upgrade_index
+from calibre_plugins.caps.indexer import BulkIndexer, FtsIndexer
+from calibre_plugins.caps.node_lifecycle import record_index_size
+from calibre_plugins.caps.search_helper import backfill_book_id_field, estimate_book_count, iter_book_id_pages
+
+TITLE = 'Power Search'
+
+BACKEND_ELASTICSEARCH = 'elasticsearch'
+BACKEND_SQLITE = 'sqlite'
+
+# Selected book ids sent per 'terms' filter when searching in selected books
+BOOK_ID_FILTER_CHUNK_SIZE = 4096
+
+# Documents of a library being rebuilt in the built-in index are kept under
+# this id until the rebuild is complete
+SQLITE_REBUILD_ID = '{}:rebuild'
+
+SQLITE_STATE_ID = '{}:{{}}'.format(BACKEND_SQLITE)
+
+# Indices already checked for documents without book_id in this session
+_book_id_field_checked = set()
+
+
+def get_library_alias(library_id):
+    return 'calibre-library-{}'.format(library_id)
+
+def get_state_id(library_id):
+    # Every backend keeps its own record of what has been indexed, so that
+    # switching backends indexes the library into the new one
+    from calibre_plugins.caps.config import prefs
+
+    if prefs['search_backend'] == BACKEND_SQLITE:
+        return SQLITE_STATE_ID.format(library_id)
+    return library_id
+
+def has_unfinished_bulk_load(library_id):
+    from calibre_plugins.caps.config import prefs
+
+    return prefs['search_backend'] == BACKEND_ELASTICSEARCH and get_library_alias(library_id) in prefs['bulk_load_restore']
+
+def text_query(text):
+    return {
+        'simple_query_string': {
+            'query': text,
+            'default_operator': 'AND'
+        }
+    }
+
+# A backend owns the index of one library. Indexing runs write into a
+# target: the live index, or for rebuilds a new one which replaces the live
+# index once published
+
+class ElasticsearchBackend(object):
+
+    def __init__(self, client, library_id):
+        self.client = client
+        self.library_id = library_id
+        self.alias = get_library_alias(library_id)
+        self.state_id = library_id
+
+    # Returns False when the index exists with an outdated mapping
+    def ensure_index(self):
+        return ensure_index(self.client, self.alias)
+
+    def upgrade_index(self):
+        upgrade_index(self.client, self.alias)
+
+    # Returns True when a run that never finished had to be cleaned up after
+    def recover(self):
+        return end_bulk_load(self.client, self.alias)
+
+    def live_target(self):
+        return self.alias
+
+    def create_rebuild_target(self):
+        return create_next_index(self.client, self.alias)
+
+    def discard(self, target):
+        self.client.indices.delete(index=target, ignore=[404])
+
+    def publish(self, target):
+        switch_alias(self.client, self.alias, target)
+
+    def optimize(self):
+        optimize_index(self.client, self.alias)
+
+    def begin_bulk_load(self, target):
+        begin_bulk_load(self.client, target)
+
+    def end_bulk_load(self, target):
+        # Also refreshes the index
+        end_bulk_load(self.client, target)
+
+    def refresh(self, target):
+        self.client.indices.refresh(index=target, ignore=[404])
+
+    def record_size(self):
+        # Sizes the heap of the next ElasticSearch launch
+        record_index_size(self.client, self.alias)
+
+    def create_indexer(self, target, deletes):
+        return BulkIndexer(self.client, target, deletes)
+
+    def clear(self):
+        delete_library_index(self.client, self.alias)
+
+    def iter_book_id_pages(self, text, book_ids, page_size):
+        # Results are grouped by book_id, which older documents may still lack
+        if self.alias not in _book_id_field_checked:
+            backfill_book_id_field(self.client, self.alias)
+            _book_id_field_checked.add(self.alias)
+
+        query = text_query(text)
+        if book_ids is None:
+            queries = [query]
+        else:
+            ids = sorted(set(book_ids))
+            queries = [{
+                'bool': {
+                    'must': query,
+                    'filter': {
+                        'terms': {
+                            'book_id': ids[i:i + BOOK_ID_FILTER_CHUNK_SIZE]
+                        }
+                    }
+                }
+            } for i in range(0, len(ids), BOOK_ID_FILTER_CHUNK_SIZE)]
+
+        for query in queries:
+            pages = iter_book_id_pages(self.client, self.alias, query, page_size)
+            try:
+                for page, book_count in pages:
+                    # A count per chunk of selected books says nothing about the total
+                    yield page, book_count if len(queries) == 1 else None
+            finally:
+                pages.close()
+
+    def estimate_book_count(self, text):
+        return estimate_book_count(self.client, self.alias, text_query(text))
+
+class SqliteBackend(object):
+
+    def __init__(self, store, library_id):
+        self.store = store
+        self.library_id = library_id
+        self.state_id = SQLITE_STATE_ID.format(library_id)
+
+    def ensure_index(self):
+        return True
+
+    def upgrade_index(self):
+        pass
+
+    def recover(self):
+        # Every committed transaction is complete, there is nothing to undo
+        return False
+
+    def live_target(self):
+        return self.library_id
+
+    def create_rebuild_target(self):
+        target = SQLITE_REBUILD_ID.format(self.library_id)
+        self.store.clear(target)
+        return target
+
+    def discard(self, target):
+        self.store.clear(target)
+
+    def publish(self, target):
+        self.store.replace(self.library_id, target)
+
+    def optimize(self):
+        # Merges the index into a single segment, which can take a while
+        def run():
+            try:
+                self.store.optimize()
+                print('{}> Optimized built-in index'.format(TITLE))
+            except Exception as ex:
+                print('{}> Could not optimize built-in index: {}'.format(TITLE, ex))
+
+        thread = threading.Thread(target=run, name='caps-fts-optimize')
+        thread.daemon = True
+        thread.start()
+
+    def begin_bulk_load(self, target):
+        pass
+
+    def end_bulk_load(self, target):
+        pass
+
+    def refresh(self, target):
+        # Documents are searchable as soon as the indexer commits them
+        pass
+
+    def record_size(self):
+        pass
+
+    def create_indexer(self, target, deletes):
+        return FtsIndexer(self.store, target, deletes)
+
+    def clear(self):
+        self.store.clear(self.library_id)
+
+    def iter_book_id_pages(self, text, book_ids, page_size):
+        matched = self.store.book_ids(self.library_id, text)
+        if book_ids is not None:
+            selected = set(book_ids)
+            matched = [book_id for book_id in matched if book_id in selected]
+        for i in range(0, len(matched), page_size):
+            yield matched[i:i + page_size], len(matched)
+
+    def estimate_book_count(self, text):
+        return self.store.count(self.library_id, text)
+
+def get_sqlite_backend(library_id):
+    return SqliteBackend(get_fts_store(), library_id)
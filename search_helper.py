@@ -0,0 +1,118 @@
+import re
+import weakref
+
+from calibre_plugins.caps.elasticsearch.exceptions import NotFoundError
+
+# Cloning indices, used to move indices of older versions under the
+# library alias, came last
+MIN_SERVER_VERSION = (7, 4)
+
+# Book counts up to this are exact, larger ones are estimated within a few percent
+BOOK_COUNT_PRECISION = 40000
+
+# Lower precision keeps the per keystroke count preview cheap
+PREVIEW_COUNT_PRECISION = 3000
+PREVIEW_REQUEST_TIMEOUT = 5.0
+
+COMPOSITE_FILTER_PATH = 'aggregations.books.after_key,aggregations.books.buckets.key,aggregations.book_count.value'
+
+_server_versions = weakref.WeakKeyDictionary()
+
+def get_server_version(client):
+    if client not in _server_versions:
+        number = client.info(filter_path='version.number')['version']['number']
+        _server_versions[client] = tuple(int(part) for part in re.findall(r'\d+', number)[:2])
+    return _server_versions[client]
+
+def check_server_version(client):
+    version = get_server_version(client)
+    if version < MIN_SERVER_VERSION:
+        raise RuntimeError('ElasticSearch {} is not supported, version {} or later is required'.format(
+            '.'.join(str(part) for part in version), '.'.join(str(part) for part in MIN_SERVER_VERSION)))
+
+def iter_book_id_pages(client, index, query, page_size):
+    # Yields (book_ids, book_count) per page, every matching book exactly once
+    # no matter how many of its formats match. book_count comes with the first
+    # response and is exact for anything but very large result sets
+    req = {
+        'size': 0,
+        'query': query,
+        'track_total_hits': False,
+        'aggs': {
+            'books': {
+                'composite': {
+                    'size': page_size,
+                    'sources': [{'book_id': {'terms': {'field': 'book_id'}}}]
+                }
+            },
+            'book_count': {
+                'cardinality': {
+                    'field': 'book_id',
+                    'precision_threshold': BOOK_COUNT_PRECISION
+                }
+            }
+        }
+    }
+    book_count = None
+    while True:
+        try:
+            res = client.search(index=index, body=req, filter_path=COMPOSITE_FILTER_PATH)
+        except NotFoundError:
+            return
+
+        aggs = res.get('aggregations', {})
+        if book_count is None:
+            book_count = int(aggs.get('book_count', {}).get('value', 0))
+            # Only needed once
+            del req['aggs']['book_count']
+
+        buckets = aggs.get('books', {}).get('buckets', [])
+        if buckets:
+            yield [int(bucket['key']['book_id']) for bucket in buckets], book_count
+
+        after_key = aggs.get('books', {}).get('after_key')
+        if len(buckets) < page_size or not after_key:
+            break
+        req['aggs']['books']['composite']['after'] = after_key
+
+def estimate_book_count(client, index, query):
+    req = {
+        'size': 0,
+        'query': query,
+        'track_total_hits': False,
+        'aggs': {
+            'book_count': {
+                'cardinality': {
+                    'field': 'book_id',
+                    'precision_threshold': PREVIEW_COUNT_PRECISION
+                }
+            }
+        }
+    }
+    try:
+        res = client.search(index=index, body=req, filter_path='aggregations.book_count.value', request_timeout=PREVIEW_REQUEST_TIMEOUT)
+    except NotFoundError:
+        return 0
+    return int(res.get('aggregations', {}).get('book_count', {}).get('value', 0))
+
+# Documents indexed before 'book_id' and 'format' became part of the source
+# only carry them in their '<book_id>:<format>' _id
+BACKFILL_SCRIPT = (
+    "int separator = ctx._id.indexOf(':');"
+    "ctx._source.book_id = Integer.parseInt(ctx._id.substring(0, separator));"
+    "ctx._source.format = ctx._id.substring(separator + 1);")
+
+def backfill_book_id_field(client, index):
+    missing = {'bool': {'must_not': {'exists': {'field': 'book_id'}}}}
+    try:
+        if not client.count(index=index, body={'query': missing})['count']:
+            return
+        client.update_by_query(
+            index=index,
+            body={'query': missing, 'script': {'source': BACKFILL_SCRIPT, 'lang': 'painless'}},
+            conflicts='proceed',
+            refresh=True,
+            wait_for_completion=True,
+            request_timeout=600)
+    except NotFoundError:
+        pass
@@ -0,0 +1,68 @@
+import threading
+
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, QRunnable
+
+TITLE = 'Power Search'
+
+class SearchSignals(QObject):
+    # Serial number of the search, book ids of the page, estimated book count or None
+    page = pyqtSignal(int, list, object)
+    # Serial number of the search, whether it was cancelled, error message
+    finished = pyqtSignal(int, bool, str)
+
+class CountSignals(QObject):
+    # Serial number of the preview, estimated book count or None on failure
+    counted = pyqtSignal(int, object)
+
+class SearchWorker(QRunnable):
+
+    def __init__(self, serial, backend, text, book_ids, page_size):
+        super(SearchWorker, self).__init__()
+        self.serial = serial
+        self.backend = backend
+        self.text = text
+        self.book_ids = book_ids
+        self.page_size = page_size
+        self.canceled = threading.Event()
+        self.signals = SearchSignals()
+
+    # Takes effect between pages; a request already sent is left to finish
+    def cancel(self):
+        self.canceled.set()
+
+    @pyqtSlot()
+    def run(self):
+        error = ''
+        try:
+            pages = self.backend.iter_book_id_pages(self.text, self.book_ids, self.page_size)
+            try:
+                for book_ids, book_count in pages:
+                    if self.canceled.is_set():
+                        break
+                    self.signals.page.emit(self.serial, book_ids, book_count)
+            finally:
+                pages.close()
+
+        except Exception as ex:
+            print('{}> Search failed: {}'.format(TITLE, ex))
+            error = str(ex) or ex.__class__.__name__
+
+        self.signals.finished.emit(self.serial, self.canceled.is_set(), error)
+
+class CountWorker(QRunnable):
+
+    def __init__(self, serial, backend, text):
+        super(CountWorker, self).__init__()
+        self.serial = serial
+        self.backend = backend
+        self.text = text
+        self.signals = CountSignals()
+
+    @pyqtSlot()
+    def run(self):
+        count = None
+        try:
+            count = self.backend.estimate_book_count(self.text)
+        except Exception as ex:
+            print('{}> Count preview failed: {}'.format(TITLE, ex))
+        self.signals.counted.emit(self.serial, count)
@@ -1,3 +1,4 @@
+import codecs
 import os
 import platform
 import subprocess
@@ -8,6 +9,8 @@ SUBPROCESS_CREATION_FLAGS = {
     'Windows': 0x00000008 # DETACHED_PROCESS
 }
 
+CREATE_NEW_PROCESS_GROUP = 0x00000200
+
 FNULL = open(os.devnull, 'w')
 
 def _get_creation_flags():
@@ -18,6 +21,41 @@ def subprocess_call(cmdline):
 
     return subprocess.call(cmdline, stdout=FNULL, stderr=FNULL, creationflags=_get_creation_flags())
 
-def subprocess_popen(cmdline, shell=False):
+def subprocess_popen(cmdline, shell=False, env=None, detach=False):
+    # A detached process outlives Calibre: it gets its own session, or on
+    # Windows its own process group, so signals sent to Calibre's do not reach it
+    if os.name == 'nt':
+        creation_flags = _get_creation_flags() | (CREATE_NEW_PROCESS_GROUP if detach else 0)
+        return subprocess.Popen(cmdline, stdout=FNULL, stderr=FNULL, creationflags=creation_flags, shell=shell, env=env)
+
+    return subprocess.Popen(cmdline, stdout=FNULL, stderr=FNULL, creationflags=_get_creation_flags(), shell=shell, env=env, start_new_session=detach)
+
+def subprocess_check_output(cmdline):
+
+    return subprocess.check_output(cmdline, stderr=FNULL, creationflags=_get_creation_flags())
 
-    return subprocess.Popen(cmdline, stdout=FNULL, stderr=FNULL, creationflags=_get_creation_flags(), shell=shell)
+def subprocess_read_lines(cmdline, chunk_size=64 * 1024):
+    # Decodes the process output incrementally as UTF-8 and returns it as a
+    # list of lines, without ever holding the whole raw output in memory
+    process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=FNULL, creationflags=_get_creation_flags())
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    lines = []
+    pending = ''
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            lines += (pending + decoder.decode(chunk)).splitlines(True)
+            # The last line may continue in the next chunk
+            pending = lines.pop() if lines else ''
+        pending += decoder.decode(b'', True)
+        if pending:
+            lines.append(pending)
+    finally:
+        process.stdout.close()
+        process.wait()
+    # Partial output of a failed run must not pass for the whole text
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmdline)
+    return lines
@@ -0,0 +1,126 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from change_tracker import ChangeTracker
+
+
+class FakeDb(object):
+
+    def add_listener(self, listener):
+        self.listener = listener
+
+    def remove_listener(self, listener):
+        pass
+
+
+def reconciled_tracker():
+    tracker = ChangeTracker()
+    tracker.attach(FakeDb())
+    tracker.mark_reconciled()
+    return tracker
+
+def test_new_library_needs_full_scan():
+    tracker = ChangeTracker()
+    tracker.attach(FakeDb())
+    assert tracker.needs_full_scan()
+
+def test_reconciled_library_only_indexes_dirty_books():
+    tracker = reconciled_tracker()
+    tracker.restore([1, 2])
+    assert not tracker.needs_full_scan()
+    assert tracker.take_dirty() == {1, 2}
+
+def test_clearing_the_index_forces_full_scan_on_next_run():
+    tracker = reconciled_tracker()
+    # What ConfigWidget.on_clear_index does to the open dialog's tracker
+    tracker.invalidate()
+    assert tracker.needs_full_scan()
+    assert tracker.take_dirty() == set()
+
+    # The full scan run reconciles again
+    tracker.mark_reconciled()
+    assert not tracker.needs_full_scan()
+
+def test_unsupported_calibre_always_needs_full_scan():
+    tracker = ChangeTracker()
+
+    class OldDb(object):
+        pass
+
+    tracker.attach(OldDb())
+    tracker.mark_reconciled()
+    assert tracker.needs_full_scan()
+
+def test_scan_started_before_clearing_the_index_is_stale():
+    tracker = ChangeTracker()
+    tracker.attach(FakeDb())
+    token = tracker.scan_token()
+    tracker.invalidate()
+    assert tracker.scan_token() != token
+
+def test_scan_started_before_switching_libraries_is_stale():
+    tracker = ChangeTracker()
+    tracker.attach(FakeDb())
+    token = tracker.scan_token()
+    tracker.attach(FakeDb())
+    assert tracker.scan_token() != token
+
+
+class EventType(object):
+    # Stands in for calibre.db.listeners.EventType
+    metadata_changed = 'metadata_changed'
+    field_link_changed = 'field_link_changed'
+    book_created = 'book_created'
+    books_removed = 'books_removed'
+    format_added = 'format_added'
+    formats_removed = 'formats_removed'
+    items_renamed = 'items_renamed'
+    items_removed = 'items_removed'
+    book_edited = 'book_edited'
+    indexing_progress_changed = 'indexing_progress_changed'
+
+@pytest.fixture
+def tracker(monkeypatch):
+    listeners = types.ModuleType('calibre.db.listeners')
+    listeners.EventType = EventType
+    monkeypatch.setitem(sys.modules, 'calibre', types.ModuleType('calibre'))
+    monkeypatch.setitem(sys.modules, 'calibre.db', types.ModuleType('calibre.db'))
+    monkeypatch.setitem(sys.modules, 'calibre.db.listeners', listeners)
+    return reconciled_tracker()
+
+def test_book_created_is_dirty(tracker):
+    tracker.on_event('lib', EventType.book_created, (7,))
+    assert tracker.take_dirty() == {7}
+
+def test_books_removed_are_dirty(tracker):
+    tracker.on_event('lib', EventType.books_removed, ((3, 4),))
+    assert tracker.take_dirty() == {3, 4}
+
+def test_format_added_is_dirty(tracker):
+    tracker.on_event('lib', EventType.format_added, (5, 'PDF'))
+    assert tracker.take_dirty() == {5}
+
+def test_formats_removed_are_dirty(tracker):
+    tracker.on_event('lib', EventType.formats_removed, ({5: ('PDF',), 6: ('EPUB',)},))
+    assert tracker.take_dirty() == {5, 6}
+
+def test_edited_book_is_dirty(tracker):
+    tracker.on_event('lib', EventType.book_edited, (8, 'EPUB'))
+    assert tracker.take_dirty() == {8}
+
+def test_tag_changes_are_dirty(tracker):
+    tracker.on_event('lib', EventType.metadata_changed, ('tags', {1, 2}))
+    tracker.on_event('lib', EventType.items_renamed, ('tags', {3}, {10: 11}))
+    tracker.on_event('lib', EventType.items_removed, ('tags', {4}, {10}))
+    assert tracker.take_dirty() == {1, 2, 3, 4}
+
+def test_other_changes_are_ignored(tracker):
+    tracker.on_event('lib', EventType.metadata_changed, ('title', {1}))
+    tracker.on_event('lib', EventType.items_renamed, ('authors', {2}, {10: 11}))
+    tracker.on_event('lib', EventType.indexing_progress_changed, (1, 2))
+    assert tracker.take_dirty() == set()
@@ -0,0 +1,102 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fts_store import FtsStore, UnsupportedQueryError, compile_query, parse_query
+
+
+def test_words_must_all_match():
+    assert parse_query('two words') == ('and', [('match', '"two"'), ('match', '"words"')])
+    assert compile_query('two words')[1] == ['("two") AND ("words")']
+
+def test_alternatives_and_groups():
+    assert compile_query('(a | b) c')[1] == ['(("a") OR ("b")) AND ("c")']
+
+def test_phrase_is_kept_together():
+    assert parse_query('"exact phrase"') == ('match', '"exact phrase"')
+
+def test_negation_next_to_positive_term_stays_in_one_match():
+    sql, params = compile_query('good -bad')
+    assert 'EXCEPT' not in sql
+    assert params == ['(("good")) NOT ("bad")']
+
+def test_negation_alone_is_taken_from_all_documents():
+    sql, params = compile_query('-bad')
+    assert 'FROM fts_docs' in sql and 'EXCEPT' in sql
+    assert params == ['"bad"']
+
+def test_wildcards_become_prefix_queries():
+    assert parse_query('te*t') == ('match', '"te"*')
+    assert parse_query('te?t') == ('match', '"te"*')
+
+def test_fuzziness_is_dropped():
+    assert parse_query('fuzzy~2') == ('match', '"fuzzy"')
+
+def test_quote_ends_a_word():
+    assert parse_query('say"') == ('match', '"say"')
+    assert parse_query('it\'s') == ('match', '"it\'s"')
+
+def test_nothing_to_search_for():
+    assert compile_query('!!!') is None
+    assert compile_query('-') is None
+    assert compile_query('') is None
+
+def test_unsupported_syntax_is_rejected():
+    with pytest.raises(UnsupportedQueryError):
+        parse_query('*suffix')
+    with pytest.raises(UnsupportedQueryError):
+        parse_query('/regex/')
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = FtsStore(str(tmp_path / 'fts.sqlite'))
+    store.index('lib', 1, 'EPUB', 'Title One', 'The quick brown fox')
+    store.index('lib', 1, 'PDF', 'Title One', 'The quick brown fox again')
+    store.index('lib', 2, 'EPUB', 'Title Two', 'A lazy dog sleeps')
+    store.index('other', 3, 'EPUB', 'Title Three', 'Another quick fox')
+    store.commit()
+    return store
+
+def test_books_are_found_once_per_library(store):
+    assert store.book_ids('lib', 'quick') == [1]
+    assert store.count('lib', 'quick') == 1
+    assert store.count('other', 'quick') == 1
+
+def test_search_is_stemmed_and_case_insensitive(store):
+    assert store.book_ids('lib', 'SLEEPING') == [2]
+
+def test_metadata_is_searched(store):
+    assert sorted(store.book_ids('lib', 'title')) == [1, 2]
+
+def test_negation_alone(store):
+    assert store.book_ids('lib', '-fox') == [2]
+
+def test_reindexing_replaces_the_text(store):
+    store.index('lib', 2, 'EPUB', 'Title Two', 'A quick cat')
+    store.commit()
+    assert store.book_ids('lib', 'dog') == []
+    assert sorted(store.book_ids('lib', 'quick')) == [1, 2]
+
+def test_delete(store):
+    store.delete('lib', 1, 'EPUB')
+    store.delete('lib', 1, 'PDF')
+    store.commit()
+    assert store.book_ids('lib', 'fox') == []
+
+def test_replace_publishes_the_rebuilt_library(store):
+    store.index('lib:rebuild', 2, 'EPUB', 'Title Two', 'A rebuilt dog')
+    store.commit()
+    store.replace('lib', 'lib:rebuild')
+    assert store.book_ids('lib', 'fox') == []
+    assert store.book_ids('lib', 'rebuilt') == [2]
+    assert store.book_ids('lib:rebuild', 'rebuilt') == []
+    assert store.book_ids('other', 'fox') == [3]
+
+def test_clear(store):
+    store.clear('lib')
+    assert store.count('lib', 'title') == 0
+    assert store.count('other', 'title') == 1
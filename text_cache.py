@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from calibre_plugins.caps.fingerprint import content_hash
+
+TITLE = 'Power Search'
+
+TEXT_CACHE_FILE_NAME = 'caps-text-cache.sqlite'
+
+COMPRESSION_LEVEL = 6
+
+
+def _file_identity(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return path, st.st_size, int(st.st_mtime * 1000000)
+
+
+class TextCache(object):
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS text_cache ('
+            ' hash TEXT PRIMARY KEY,'
+            ' path TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime INTEGER NOT NULL,'
+            ' stored_bytes INTEGER NOT NULL,'
+            ' last_used REAL NOT NULL,'
+            ' data BLOB NOT NULL'
+            ')')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS text_cache_path ON text_cache (path)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS text_cache_last_used ON text_cache (last_used)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(stored_bytes), 0) FROM text_cache').fetchone()[0]
+
+    # Returns cached content (list of lines, or None on a miss) and the key
+    # to pass to store() once the book has been converted
+    def lookup(self, input, digest=None):
+        path, size, mtime = _file_identity(input)
+
+        if digest is None:
+            with self.lock:
+                row = self.conn.execute(
+                    'SELECT hash FROM text_cache WHERE path = ? AND size = ? AND mtime = ?',
+                    (path, size, mtime)).fetchone()
+
+            # Path, size or mtime changed: the bytes may still be the same
+            digest = row[0] if row else content_hash(path)
+        key = (digest, path, size, mtime)
+
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM text_cache WHERE hash = ?', (digest,)).fetchone()
+            if not row:
+                return None, key
+            self.conn.execute(
+                'UPDATE text_cache SET path = ?, size = ?, mtime = ?, last_used = ? WHERE hash = ?',
+                (path, size, mtime, time.time(), digest))
+            self.conn.commit()
+
+        text = zlib.decompress(row[0]).decode('utf-8')
+        return text.splitlines(True), key
+
+    def store(self, key, content):
+        digest, path, size, mtime = key
+        data = zlib.compress(''.join(content).encode('utf-8'), COMPRESSION_LEVEL)
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            row = self.conn.execute('SELECT stored_bytes FROM text_cache WHERE hash = ?', (digest,)).fetchone()
+            if row:
+                self.total_bytes -= row[0]
+            # The text of an older revision of the same file is of no further use
+            for old_digest, stored_bytes in self.conn.execute(
+                    'SELECT hash, stored_bytes FROM text_cache WHERE path = ? AND hash != ?', (path, digest)).fetchall():
+                self.conn.execute('DELETE FROM text_cache WHERE hash = ?', (old_digest,))
+                self.total_bytes -= stored_bytes
+            self.conn.execute(
+                'INSERT OR REPLACE INTO text_cache (hash, path, size, mtime, stored_bytes, last_used, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (digest, path, size, mtime, len(data), time.time(), sqlite3.Binary(data)))
+            self.total_bytes += len(data)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                'SELECT hash, stored_bytes FROM text_cache ORDER BY last_used LIMIT 100').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for digest, stored_bytes in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM text_cache WHERE hash = ?', (digest,))
+                self.total_bytes -= stored_bytes
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+            self.conn.commit()
+
+    # Drops entries whose source file is gone, i.e. deleted books and formats
+    def prune(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT hash, path, stored_bytes FROM text_cache').fetchall()
+
+        stale = [(digest, stored_bytes) for digest, path, stored_bytes in rows if not os.path.exists(path)]
+        if not stale:
+            return
+
+        with self.lock:
+            for digest, stored_bytes in stale:
+                if self.conn.execute('DELETE FROM text_cache WHERE hash = ?', (digest,)).rowcount:
+                    self.total_bytes -= stored_bytes
+            self.conn.commit()
+        print('{}> Pruned {} text cache entries'.format(TITLE, len(stale)))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM text_cache')
+            self.conn.commit()
+            self.conn.execute('VACUUM')
+            self.total_bytes = 0
+
+
+_cache = None
+
+def get_text_cache():
+    global _cache
+
+    from calibre_plugins.caps.config import prefs
+
+    max_bytes = prefs['text_cache_size_mb'] * 1024 * 1024
+    if _cache is None:
+        _cache = TextCache(os.path.join(os.path.dirname(prefs.file_path), TEXT_CACHE_FILE_NAME), max_bytes)
+    elif _cache.max_bytes != max_bytes:
+        _cache.set_max_bytes(max_bytes)
+
+    return _cache
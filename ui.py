@@ -3,6 +3,7 @@ from functools import partial
 from calibre.gui2 import error_dialog
 from calibre.gui2.actions import InterfaceAction
 from calibre_plugins.caps.main import SearchDialog
+from calibre_plugins.caps.scheduler import IndexScheduler
 
 if False:
     get_icons = lambda x: x
@@ -18,6 +19,7 @@ class CapsPlugin(InterfaceAction):
     action_menu_clone_qaction = True
 
     search_dialog = None
+    scheduler = None
 
     def genesis(self):
         icon = get_icons('images/icon.png')
@@ -29,6 +31,12 @@ class CapsPlugin(InterfaceAction):
         cm('reindex all', 'Reindex all books', triggered=self.reindex_all_books)
         cm('options', 'Options', triggered=self.show_options)
         cm('readme', 'Readme', triggered=self.show_readme)
+        self.scheduler = IndexScheduler(self)
+
+    def initialization_complete(self):
+        from calibre_plugins.caps.config import prefs
+        if prefs['background_indexing']:
+            self.scheduler.start()
 
     def _init_dialog(self):
         base_plugin_object = self.interface_action_base_plugin
@@ -36,6 +44,10 @@ class CapsPlugin(InterfaceAction):
         if not self.search_dialog:
             self.search_dialog = SearchDialog(base_plugin_object, self.gui, self.qaction.icon())
 
+    def get_search_dialog(self):
+        self._init_dialog()
+        return self.search_dialog
+
     def show_dialog(self):
         self._init_dialog()
         self.search_dialog.show()
@@ -60,7 +72,8 @@ class CapsPlugin(InterfaceAction):
 
     def apply_settings(self):
         from calibre_plugins.caps.config import prefs
-        # In an actual non trivial plugin, you would probably need to
-        # do something based on the settings in prefs
-        prefs
+        if prefs['background_indexing']:
+            self.scheduler.start()
+        else:
+            self.scheduler.stop()
 